@@ -2,8 +2,13 @@
 Database utilities using Supabase
 Requires Supabase to be configured
 """
+import hmac
 import os
-from typing import Dict, List, Optional
+import sys
+import threading
+import time
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
 from datetime import datetime
 
 # Import Supabase
@@ -12,20 +17,79 @@ try:
 except ImportError:
     raise ImportError("supabase package is required. Install with: pip install supabase")
 
+# Max rows sent per bulk upsert request
+UPSERT_CHUNK_SIZE = 500
 
+# How long reads from load_subscriptions / load_state are served from memory
+CACHE_TTL_SECONDS = float(os.getenv('DB_CACHE_TTL_SECONDS', '30'))
+
+# How long the Popular Items reads (get_popular_items / get_last_in_stock_times) are served from memory
+POPULAR_CACHE_TTL_SECONDS = float(os.getenv('DB_POPULAR_CACHE_TTL_SECONDS', '300'))
+
+
+class _TTLCache:
+    """Small thread-safe cache whose entries expire after a fixed TTL."""
+    
+    def __init__(self, ttl: float, maxsize: int = 128):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data = {}
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            return value
+    
+    def set(self, key, value):
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            if key not in self._data and len(self._data) >= self.maxsize:
+                # Evict the entry closest to expiry
+                oldest = min(self._data, key=lambda k: self._data[k][0])
+                del self._data[oldest]
+            self._data[key] = (time.monotonic() + self.ttl, value)
+    
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+    
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+_subscriptions_cache = _TTLCache(CACHE_TTL_SECONDS, maxsize=1)
+_state_cache = _TTLCache(CACHE_TTL_SECONDS)
+_popular_cache = _TTLCache(POPULAR_CACHE_TTL_SECONDS)
+_last_in_stock_cache = _TTLCache(POPULAR_CACHE_TTL_SECONDS, maxsize=256)
+
+
+@lru_cache(maxsize=1)
 def get_supabase_client():
-    """Get Supabase client. Raises error if not configured."""
+    """
+    Get Supabase client. Raises error if not configured.
+    The client is created once per process and reused so its connection pool is shared.
+    """
     url = os.getenv('SUPABASE_URL')
     key = os.getenv('SUPABASE_KEY')
     
-    # Try Streamlit secrets if available
-    try:
-        import streamlit as st
-        if hasattr(st, 'secrets'):
+    # Fall back to Streamlit secrets when running inside the Streamlit app.
+    # Streamlit is only looked up if it is already loaded, so the scheduler never pays for importing it.
+    st = sys.modules.get('streamlit')
+    if (not url or not key) and st is not None:
+        try:
             url = url or st.secrets.get('SUPABASE_URL')
             key = key or st.secrets.get('SUPABASE_KEY')
-    except:
-        pass
+        except:
+            pass
     
     if not url or not key:
         raise ValueError(
@@ -36,50 +100,180 @@ def get_supabase_client():
     return create_client(url, key)
 
 
+def _row_to_subscription(row: Dict) -> Dict:
+    """Convert a subscriptions row into the subscription dict used by the app."""
+    return {
+        'id': row['id'],
+        'email': row['email'],
+        'product_url': row['product_url'],
+        'token': row['token'],
+        'verified': row.get('verified', False),
+        'created_at': row.get('created_at'),
+        'last_notified': row.get('last_notified')
+    }
+
+
 def load_subscriptions() -> Dict:
-    """Load subscriptions from Supabase."""
+    """Load subscriptions from Supabase. Results are cached for CACHE_TTL_SECONDS."""
+    cached = _subscriptions_cache.get('all')
+    if cached is not None:
+        # Callers mutate subscriptions before saving, so hand out copies
+        return {sub_id: dict(sub) for sub_id, sub in cached.items()}
+    
     supabase = get_supabase_client()
     
     try:
         response = supabase.table('subscriptions').select('*').execute()
-        subscriptions = {}
-        for row in response.data:
-            subscriptions[row['id']] = {
-                'email': row['email'],
-                'product_url': row['product_url'],
-                'token': row['token'],
-                'verified': row.get('verified', False),
-                'created_at': row.get('created_at'),
-                'last_notified': row.get('last_notified')
-            }
+        subscriptions = {row['id']: _row_to_subscription(row) for row in response.data}
+        _subscriptions_cache.set('all', {sub_id: dict(sub) for sub_id, sub in subscriptions.items()})
         return subscriptions
     except Exception as e:
         raise Exception(f"Error loading subscriptions from Supabase: {e}")
 
 
+def get_subscription_by_token(token: str) -> Optional[Tuple[str, Dict]]:
+    """
+    Look up the subscription with a verification token, using the token index.
+    Returns (subscription_id, subscription) or None if no subscription has that token.
+    """
+    if not token:
+        return None
+    
+    supabase = get_supabase_client()
+    
+    try:
+        response = supabase.table('subscriptions')\
+            .select('*')\
+            .eq('token', token)\
+            .limit(1)\
+            .execute()
+    except Exception as e:
+        raise Exception(f"Error looking up subscription token in Supabase: {e}")
+    
+    if not response.data:
+        return None
+    sub = _row_to_subscription(response.data[0])
+    # Confirm the match in constant time rather than trusting the query predicate alone
+    if not sub['token'] or not hmac.compare_digest(str(sub['token']).encode(), token.encode()):
+        return None
+    return sub['id'], sub
+
+
+def get_subscriptions_by_email(email: str) -> Dict:
+    """
+    Load one email address's subscriptions, filtered by Supabase using the email index.
+    Returns a dict keyed by subscription ID like load_subscriptions.
+    """
+    if not email:
+        return {}
+    
+    supabase = get_supabase_client()
+    
+    try:
+        response = supabase.table('subscriptions')\
+            .select('*')\
+            .eq('email', email)\
+            .execute()
+        return {row['id']: _row_to_subscription(row) for row in response.data}
+    except Exception as e:
+        raise Exception(f"Error loading subscriptions for email from Supabase: {e}")
+
+
+def load_active_subscriptions() -> Dict:
+    """
+    Load only the verified subscriptions the scheduler needs, with just the columns it uses.
+    Returns a dict keyed by subscription ID like load_subscriptions.
+    """
+    supabase = get_supabase_client()
+    
+    try:
+        response = supabase.table('subscriptions')\
+            .select('id, email, product_url, last_notified')\
+            .eq('verified', True)\
+            .execute()
+        return {row['id']: row for row in response.data}
+    except Exception as e:
+        raise Exception(f"Error loading active subscriptions from Supabase: {e}")
+
+
+def mark_notified(subscription_ids: List[str], notified_at: Optional[str] = None):
+    """Set last_notified on several subscriptions with one update per chunk of IDs."""
+    if not subscription_ids:
+        return
+    
+    supabase = get_supabase_client()
+    notified_at = notified_at or datetime.now().isoformat()
+    _subscriptions_cache.clear()
+    
+    try:
+        for i in range(0, len(subscription_ids), UPSERT_CHUNK_SIZE):
+            supabase.table('subscriptions')\
+                .update({'last_notified': notified_at})\
+                .in_('id', subscription_ids[i:i + UPSERT_CHUNK_SIZE])\
+                .execute()
+    except Exception as e:
+        raise Exception(f"Error updating last_notified in Supabase: {e}")
+
+
+def _subscription_row(sub_id: str, sub_data: Dict) -> Dict:
+    """Build the subscriptions row to upsert for a subscription dict."""
+    return {
+        'id': sub_id,
+        'email': sub_data['email'],
+        'product_url': sub_data['product_url'],
+        'token': sub_data['token'],
+        'verified': sub_data.get('verified', False),
+        'created_at': sub_data.get('created_at'),
+        'last_notified': sub_data.get('last_notified')
+    }
+
+
 def save_subscriptions(subscriptions: Dict):
     """Save subscriptions to Supabase."""
     supabase = get_supabase_client()
     
+    rows = [_subscription_row(sub_id, sub_data) for sub_id, sub_data in subscriptions.items()]
+    
+    _subscriptions_cache.clear()
+    _popular_cache.clear()
+    
     try:
-        # Upsert all subscriptions
-        for sub_id, sub_data in subscriptions.items():
-            supabase.table('subscriptions').upsert({
-                'id': sub_id,
-                'email': sub_data['email'],
-                'product_url': sub_data['product_url'],
-                'token': sub_data['token'],
-                'verified': sub_data.get('verified', False),
-                'created_at': sub_data.get('created_at'),
-                'last_notified': sub_data.get('last_notified')
-            }).execute()
+        # Upsert all subscriptions in as few requests as possible
+        for i in range(0, len(rows), UPSERT_CHUNK_SIZE):
+            supabase.table('subscriptions').upsert(rows[i:i + UPSERT_CHUNK_SIZE]).execute()
     except Exception as e:
         raise Exception(f"Error saving subscriptions to Supabase: {e}")
 
 
+def save_subscription(subscription_id: str, subscription: Dict):
+    """Save a single subscription to Supabase, leaving every other row alone."""
+    supabase = get_supabase_client()
+    _subscriptions_cache.clear()
+    _popular_cache.clear()
+    
+    try:
+        supabase.table('subscriptions').upsert(_subscription_row(subscription_id, subscription)).execute()
+    except Exception as e:
+        raise Exception(f"Error saving subscription to Supabase: {e}")
+
+
+def set_verified(subscription_id: str, verified: bool = True):
+    """Set the verified flag on one subscription."""
+    supabase = get_supabase_client()
+    _subscriptions_cache.clear()
+    _popular_cache.clear()
+    
+    try:
+        supabase.table('subscriptions').update({'verified': verified}).eq('id', subscription_id).execute()
+    except Exception as e:
+        raise Exception(f"Error updating subscription in Supabase: {e}")
+
+
 def delete_subscription(subscription_id: str):
     """Delete a subscription from Supabase by ID."""
     supabase = get_supabase_client()
+    _subscriptions_cache.clear()
+    _popular_cache.clear()
     
     try:
         supabase.table('subscriptions').delete().eq('id', subscription_id).execute()
@@ -87,33 +281,72 @@ def delete_subscription(subscription_id: str):
         raise Exception(f"Error deleting subscription from Supabase: {e}")
 
 
+def _row_to_state(row: Optional[Dict]) -> Dict:
+    """Convert a stock_state row into the state dict used by the scheduler."""
+    if not row:
+        return {'color_stock': {}, 'color_size_stock': {}, 'last_checked': None, 'has_sizes': None}
+    return {
+        'color_stock': row.get('color_stock') or {},
+        'color_size_stock': row.get('color_size_stock') or {},
+        'last_checked': row.get('last_checked'),
+        'has_sizes': row.get('has_sizes'),
+        'product_name': row.get('product_name'),
+        'etag': row.get('etag'),
+        'last_modified': row.get('last_modified')
+    }
+
+
 def load_state(product_url: str) -> Dict:
-    """Load the last known stock state for a product from Supabase."""
+    """Load the last known stock state for a product from Supabase. Results are cached for CACHE_TTL_SECONDS."""
+    cached = _state_cache.get(product_url)
+    if cached is not None:
+        return dict(cached)
+    
     supabase = get_supabase_client()
     
     try:
         response = supabase.table('stock_state').select('*').eq('product_url', product_url).execute()
-        
-        if response.data and len(response.data) > 0:
-            row = response.data[0]
-            return {
-                'color_stock': row.get('color_stock') or {},
-                'color_size_stock': row.get('color_size_stock') or {},
-                'last_checked': row.get('last_checked'),
-                'has_sizes': row.get('has_sizes'),
-                'product_name': row.get('product_name')
-            }
-        else:
-            return {'color_stock': {}, 'color_size_stock': {}, 'last_checked': None, 'has_sizes': None}
+        state = _row_to_state(response.data[0] if response.data else None)
+        _state_cache.set(product_url, state)
+        return dict(state)
     except Exception as e:
         raise Exception(f"Error loading state from Supabase: {e}")
 
 
+def load_states(product_urls: List[str]) -> Dict[str, Dict]:
+    """
+    Load the last known stock state for several products in a single query.
+    Returns a dict keyed by product URL; products without saved state get an empty state.
+    """
+    if not product_urls:
+        return {}
+    
+    supabase = get_supabase_client()
+    
+    try:
+        response = supabase.table('stock_state').select('*').in_('product_url', product_urls).execute()
+        rows = {row['product_url']: row for row in response.data}
+        return {product_url: _row_to_state(rows.get(product_url)) for product_url in product_urls}
+    except Exception as e:
+        raise Exception(f"Error loading states from Supabase: {e}")
+
+
+def _upsert_states(rows: List[Dict]):
+    """Upsert stock_state rows, chunked to keep request payloads bounded."""
+    supabase = get_supabase_client()
+    for row in rows:
+        _state_cache.pop(row['product_url'])
+    
+    try:
+        for i in range(0, len(rows), UPSERT_CHUNK_SIZE):
+            supabase.table('stock_state').upsert(rows[i:i + UPSERT_CHUNK_SIZE]).execute()
+    except Exception as e:
+        raise Exception(f"Error saving state to Supabase: {e}")
+
+
 def save_state(product_url: str, color_stock: Dict = None, color_size_stock: Dict = None,
                has_sizes: bool = None, product_name: str = None):
     """Save the current stock state to Supabase."""
-    supabase = get_supabase_client()
-    
     state_data = {
         'product_url': product_url,
         'last_checked': datetime.now().isoformat()
@@ -131,25 +364,63 @@ def save_state(product_url: str, color_stock: Dict = None, color_size_stock: Dic
     if color_size_stock is not None:
         state_data['color_size_stock'] = color_size_stock
     
-    try:
-        supabase.table('stock_state').upsert(state_data).execute()
-    except Exception as e:
-        raise Exception(f"Error saving state to Supabase: {e}")
+    _upsert_states([state_data])
+
+
+def save_states(rows: List[Dict]):
+    """
+    Save the stock state for several products at once.
+    Rows should all have the same keys, since they are sent as one bulk upsert.
+    """
+    if rows:
+        _upsert_states(rows)
 
 
 def save_stock_history(product_url: str, product_name: str, color: str, size: Optional[str] = None):
     """Record when an item comes back in stock."""
+    save_stock_history_batch([{
+        'product_url': product_url,
+        'product_name': product_name,
+        'color': color,
+        'size': size,
+        'came_back_in_stock_at': datetime.now().isoformat()
+    }])
+
+
+def save_stock_history_batch(rows: List[Dict]):
+    """
+    Record several back-in-stock events at once.
+    Each row needs product_url, product_name, color, size and came_back_in_stock_at.
+    Events are appended to stock_history, and stock_last_in_stock keeps the latest
+    time per product/color/size.
+    """
+    if not rows:
+        return
+    
     supabase = get_supabase_client()
     
+    # One row per combination, since an upsert cannot touch the same row twice
+    latest = {}
+    for row in rows:
+        key = (row['product_url'], row['color'], row.get('size'))
+        if key not in latest or row['came_back_in_stock_at'] > latest[key]['came_back_in_stock_at']:
+            latest[key] = {
+                'product_url': row['product_url'],
+                'color': row['color'],
+                'size': row.get('size'),
+                'came_back_in_stock_at': row['came_back_in_stock_at']
+            }
+    latest_rows = list(latest.values())
+    for product_url in {row['product_url'] for row in latest_rows}:
+        _last_in_stock_cache.pop(product_url)
+    
     try:
-        history_data = {
-            'product_url': product_url,
-            'product_name': product_name,
-            'color': color,
-            'size': size,
-            'came_back_in_stock_at': datetime.now().isoformat()
-        }
-        supabase.table('stock_history').insert(history_data).execute()
+        for i in range(0, len(rows), UPSERT_CHUNK_SIZE):
+            supabase.table('stock_history').insert(rows[i:i + UPSERT_CHUNK_SIZE]).execute()
+        for i in range(0, len(latest_rows), UPSERT_CHUNK_SIZE):
+            supabase.table('stock_last_in_stock')\
+                .upsert(latest_rows[i:i + UPSERT_CHUNK_SIZE], on_conflict='product_url,color,size')\
+                .execute()
     except Exception as e:
         raise Exception(f"Error saving stock history to Supabase: {e}")
 
@@ -158,33 +429,34 @@ def get_popular_items(limit: int = 20) -> List[Dict]:
     """
     Get popular items based on number of subscriptions.
     Returns list of products with subscription counts.
+    Counting is done by the popular_items view (see supabase/migrations).
+    Results are cached for POPULAR_CACHE_TTL_SECONDS.
     """
+    cached = _popular_cache.get(limit)
+    if cached is not None:
+        return [dict(item) for item in cached]
+    
     supabase = get_supabase_client()
     
     try:
-        # Get subscription counts per product
-        subscriptions = load_subscriptions()
-        product_counts = {}
-        for sub in subscriptions.values():
-            if sub.get('verified', False):
-                product_url = sub['product_url']
-                product_counts[product_url] = product_counts.get(product_url, 0) + 1
-        
-        # Get product details from stock_state
-        popular_items = []
-        for product_url, sub_count in sorted(product_counts.items(), key=lambda x: x[1], reverse=True)[:limit]:
-            response = supabase.table('stock_state').select('*').eq('product_url', product_url).execute()
-            if response.data and len(response.data) > 0:
-                row = response.data[0]
-                popular_items.append({
-                    'product_url': product_url,
-                    'product_name': row.get('product_name', 'Unknown Product'),
-                    'subscription_count': sub_count,
-                    'has_sizes': row.get('has_sizes', False),
-                    'last_checked': row.get('last_checked')
-                })
+        response = supabase.table('popular_items')\
+            .select('product_url, product_name, subscription_count, has_sizes, last_checked')\
+            .order('subscription_count', desc=True)\
+            .limit(limit)\
+            .execute()
         
-        return popular_items
+        items = [
+            {
+                'product_url': row['product_url'],
+                'product_name': row.get('product_name') or 'Unknown Product',
+                'subscription_count': row['subscription_count'],
+                'has_sizes': row.get('has_sizes') or False,
+                'last_checked': row.get('last_checked')
+            }
+            for row in response.data
+        ]
+        _popular_cache.set(limit, [dict(item) for item in items])
+        return items
     except Exception as e:
         raise Exception(f"Error getting popular items from Supabase: {e}")
 
@@ -199,36 +471,75 @@ def get_last_in_stock_times(product_url: str) -> Dict:
             None: 'timestamp'  # for products without sizes
         }
     }
+    Results are cached for POPULAR_CACHE_TTL_SECONDS.
     """
+    cached = _last_in_stock_cache.get(product_url)
+    if cached is not None:
+        return {color: dict(sizes) for color, sizes in cached.items()}
+    
     supabase = get_supabase_client()
     
     try:
-        response = supabase.table('stock_history')\
+        # stock_last_in_stock holds one row per color/size, already the most recent
+        response = supabase.table('stock_last_in_stock')\
             .select('color, size, came_back_in_stock_at')\
             .eq('product_url', product_url)\
-            .order('came_back_in_stock_at', desc=True)\
             .execute()
         
         last_times = {}
-        seen_combinations = set()
         for row in response.data:
-            color = row['color']
-            size = row.get('size')
-            timestamp = row['came_back_in_stock_at']
-            
-            # Create a unique key for this color/size combination
-            combination_key = (color, size)
-            
-            # Since results are ordered by timestamp DESC, first occurrence is most recent
-            if combination_key not in seen_combinations:
-                seen_combinations.add(combination_key)
-                
-                if color not in last_times:
-                    last_times[color] = {}
-                
-                last_times[color][size] = timestamp
+            last_times.setdefault(row['color'], {})[row.get('size')] = row['came_back_in_stock_at']
         
+        _last_in_stock_cache.set(product_url, {color: dict(sizes) for color, sizes in last_times.items()})
         return last_times
     except Exception as e:
         raise Exception(f"Error getting last in-stock times from Supabase: {e}")
 
+
+
+def get_last_in_stock_times_batch(product_urls: List[str]) -> Dict[str, Dict]:
+    """
+    get_last_in_stock_times for several products with one IN query per chunk of URLs.
+    Products cached by get_last_in_stock_times are served from memory.
+    Returns a dict mapping every requested URL to its last in-stock times.
+    """
+    results = {}
+    missing = []
+    for product_url in dict.fromkeys(product_urls):
+        cached = _last_in_stock_cache.get(product_url)
+        if cached is not None:
+            results[product_url] = {color: dict(sizes) for color, sizes in cached.items()}
+        else:
+            missing.append(product_url)
+    
+    if not missing:
+        return results
+    
+    supabase = get_supabase_client()
+    
+    try:
+        fetched = {product_url: {} for product_url in missing}
+        for i in range(0, len(missing), UPSERT_CHUNK_SIZE):
+            response = supabase.table('stock_last_in_stock')\
+                .select('product_url, color, size, came_back_in_stock_at')\
+                .in_('product_url', missing[i:i + UPSERT_CHUNK_SIZE])\
+                .execute()
+            for row in response.data:
+                fetched[row['product_url']].setdefault(row['color'], {})[row.get('size')] = row['came_back_in_stock_at']
+    except Exception as e:
+        raise Exception(f"Error getting last in-stock times from Supabase: {e}")
+    
+    for product_url, last_times in fetched.items():
+        _last_in_stock_cache.set(product_url, {color: dict(sizes) for color, sizes in last_times.items()})
+        results[product_url] = last_times
+    return results
+
+
+def get_popular_items_with_history(limit: int = 20) -> List[Tuple[Dict, Dict]]:
+    """
+    Everything the Popular Items page renders in two queries:
+    a list of (item, last_in_stock_times) pairs, most subscribed first.
+    """
+    items = get_popular_items(limit)
+    histories = get_last_in_stock_times_batch([item['product_url'] for item in items])
+    return [(item, histories.get(item['product_url'], {})) for item in items]
@@ -0,0 +1,369 @@
+"""
+SMTP connection pooling for outgoing emails
+Keeps one authenticated connection per (server, port, user) so a batch of
+emails pays the connect + STARTTLS + login handshake once
+"""
+import atexit
+import os
+import re
+import smtplib
+import sys
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from email.mime.text import MIMEText
+from functools import lru_cache
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+from urllib.parse import quote
+
+from jinja2 import Environment, FileSystemLoader, StrictUndefined
+
+
+@lru_cache(maxsize=128)
+def get_env_var(key: str, default: Optional[str] = None) -> Optional[str]:
+    """
+    Read a setting from the environment, falling back to Streamlit secrets when running in the app.
+    Cached for the life of the process; call get_env_var.cache_clear() after rotating secrets.
+    """
+    value = os.getenv(key)
+    # Secrets exist only inside the Streamlit app; elsewhere streamlit isn't imported
+    st = sys.modules.get('streamlit')
+    if value is None and st is not None:
+        try:
+            value = st.secrets.get(key)
+        except Exception:
+            pass
+    return default if value is None else value
+
+
+# Email settings, read once at import
+SENDER_EMAIL = get_env_var('SENDER_EMAIL')
+SENDER_PASSWORD = get_env_var('SENDER_PASSWORD')
+SMTP_SERVER = get_env_var('SMTP_SERVER', 'smtp.gmail.com')
+SMTP_PORT = int(get_env_var('SMTP_PORT', '587'))
+SMTP_TIMEOUT = int(get_env_var('SMTP_TIMEOUT', '15'))
+
+# Background threads sending emails for interactive callers
+MAIL_WORKERS = int(get_env_var('MAIL_WORKERS', '4'))
+
+# Where verification links point; the app reads the token from the query string
+APP_URL = get_env_var('APP_URL', 'https://arc-scraper.vercel.app/')
+
+# Recycle a connection after this many messages; providers throttle or drop long-lived ones
+SMTP_MAX_PER_CONN = int(get_env_var('SMTP_MAX_PER_CONN', '100'))
+
+# Max recipients per message when the same email goes out to many people as BCC
+SMTP_MAX_RECIPIENTS = int(get_env_var('SMTP_MAX_RECIPIENTS', '50'))
+
+# Pipeline the envelope commands (RFC 2920) when the server advertises PIPELINING
+SMTP_PIPELINING = str(get_env_var('SMTP_PIPELINING', 'true')).lower() in ('1', 'true', 'yes')
+
+# After a failed connect or login, new connections are refused for 2^failures seconds, up to this cap
+SMTP_MAX_BACKOFF_SECONDS = float(get_env_var('SMTP_MAX_BACKOFF_SECONDS', '60'))
+
+# Connections idle for longer than this are checked with NOOP before reuse
+SMTP_NOOP_AFTER_SECONDS = float(get_env_var('SMTP_NOOP_AFTER_SECONDS', '10'))
+
+
+# Email bodies live in app/templates; templates are compiled once and never reloaded
+_template_env = Environment(
+    loader=FileSystemLoader(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')),
+    auto_reload=False,
+    cache_size=50,
+    trim_blocks=True,
+    keep_trailing_newline=True,
+    undefined=StrictUndefined,
+)
+
+
+def email_configured() -> bool:
+    """Check whether sender credentials are set."""
+    return all([SENDER_EMAIL, SENDER_PASSWORD])
+
+
+# Compiled at import so the first send doesn't pay for it and a broken template fails at startup
+_templates = {name: _template_env.get_template(name) for name in ('stock_alert.txt', 'verify.txt')}
+
+VERIFY_SUBJECT = "Verify your Arc'teryx stock alert subscription"
+
+
+def render_template(name: str, **context) -> str:
+    """Render one of the plain-text email templates."""
+    template = _templates.get(name) or _template_env.get_template(name)
+    return template.render(**context)
+
+
+_EOL_RE = re.compile(r'(?:\r\n|\n|\r(?!\n))')
+_LEADING_DOT_RE = re.compile(br'(?m)^\.')
+
+
+def _encode_data(msg: Union[str, bytes]) -> bytes:
+    """Encode a message for the DATA phase the way smtplib does: CRLF line ends, dot-stuffing, final '.'."""
+    if isinstance(msg, str):
+        msg = _EOL_RE.sub('\r\n', msg).encode('ascii')
+    data = _LEADING_DOT_RE.sub(b'..', msg)
+    if not data.endswith(b'\r\n'):
+        data += b'\r\n'
+    return data + b'.\r\n'
+
+
+def pipelined_sendmail(conn: smtplib.SMTP, from_addr: str, to_addrs: Union[str, List[str]],
+                       msg: Union[str, bytes]) -> Dict[str, Tuple[int, bytes]]:
+    """
+    Like smtplib.SMTP.sendmail, but MAIL FROM, every RCPT TO and DATA are written
+    back to back and their replies read afterwards, so the envelope costs one
+    round-trip instead of one per command. Falls back to sendmail when the server
+    doesn't advertise PIPELINING. Returns the refused recipients, like sendmail.
+    """
+    conn.ehlo_or_helo_if_needed()
+    if not conn.has_extn('pipelining'):
+        return conn.sendmail(from_addr, to_addrs, msg)
+    if isinstance(to_addrs, str):
+        to_addrs = [to_addrs]
+    
+    conn.putcmd('mail', f'FROM:{smtplib.quoteaddr(from_addr)}')
+    for addr in to_addrs:
+        conn.putcmd('rcpt', f'TO:{smtplib.quoteaddr(addr)}')
+    conn.putcmd('data')
+    
+    # Replies come back in command order; read them all so the connection stays in sync
+    mail_code, mail_resp = conn.getreply()
+    refused = {}
+    for addr in to_addrs:
+        code, resp = conn.getreply()
+        if code not in (250, 251):
+            refused[addr] = (code, resp)
+    data_code, data_resp = conn.getreply()
+    
+    rejected = mail_code != 250 or len(refused) == len(to_addrs)
+    if data_code == 354 and rejected:
+        # Servers should refuse DATA without recipients; if one didn't, end the empty message
+        conn.send(b'.\r\n')
+        conn.getreply()
+    if mail_code != 250:
+        conn.rset()
+        raise smtplib.SMTPSenderRefused(mail_code, mail_resp, from_addr)
+    if len(refused) == len(to_addrs):
+        conn.rset()
+        raise smtplib.SMTPRecipientsRefused(refused)
+    if data_code != 354:
+        conn.rset()
+        raise smtplib.SMTPDataError(data_code, data_resp)
+    
+    conn.send(_encode_data(msg))
+    code, resp = conn.getreply()
+    if code != 250:
+        if code == 421:
+            conn.close()
+        else:
+            conn.rset()
+        raise smtplib.SMTPDataError(code, resp)
+    return refused
+
+
+class PooledSMTP:
+    """
+    A pooled SMTP connection that counts the messages sent over it and quits
+    after SMTP_MAX_PER_CONN, so the pool opens a fresh one on the next get_connection().
+    Other smtplib.SMTP methods are passed through.
+    """
+    
+    def __init__(self, conn: smtplib.SMTP, max_messages: int = SMTP_MAX_PER_CONN):
+        self.conn = conn
+        self.sent_count = 0
+        self.max_messages = max_messages
+        self.last_used = time.monotonic()
+    
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+    
+    def _count_sent(self):
+        self.sent_count += 1
+        if self.max_messages > 0 and self.sent_count >= self.max_messages:
+            self.close()
+    
+    def send_message(self, msg, *args, **kwargs):
+        result = self.conn.send_message(msg, *args, **kwargs)
+        self._count_sent()
+        return result
+    
+    def sendmail(self, from_addr, to_addrs, msg, *args, **kwargs):
+        if SMTP_PIPELINING and not args and not kwargs:
+            result = pipelined_sendmail(self.conn, from_addr, to_addrs, msg)
+        else:
+            result = self.conn.sendmail(from_addr, to_addrs, msg, *args, **kwargs)
+        self._count_sent()
+        return result
+    
+    @property
+    def closed(self) -> bool:
+        return self.conn is None
+    
+    def close(self):
+        """Quit the underlying connection."""
+        conn, self.conn = self.conn, None
+        if conn is not None:
+            try:
+                conn.quit()
+            except Exception:
+                pass
+
+
+class SMTPTemporarilyUnavailable(Exception):
+    """Raised instead of connecting while the pool is backing off after a failed connect or login."""
+    
+    def __init__(self, retry_after: float):
+        self.retry_after = retry_after
+        super().__init__(f"Email service is temporarily unavailable, retry in {retry_after:.0f} seconds")
+
+
+class SMTPPool:
+    """
+    Thread-safe cache of live, authenticated SMTP connections keyed by (server, port, user).
+    get_connection() checks a connection out for the duration of the with block and puts it
+    back afterwards, so threads sending at the same time each get their own connection.
+    """
+    
+    def __init__(self):
+        self._idle: Dict[Tuple[str, int, str], List[PooledSMTP]] = {}
+        self._failures = 0
+        self._cooldown_until = 0.0
+        # Guards the idle lists and backoff state only; never held while talking to a server
+        self._lock = threading.Lock()
+    
+    def _connect(self, key: Tuple[str, int, str], password: str) -> PooledSMTP:
+        # Don't hammer a server that just refused us; providers throttle or ban repeated logins
+        with self._lock:
+            remaining = self._cooldown_until - time.monotonic()
+        if remaining > 0:
+            raise SMTPTemporarilyUnavailable(remaining)
+        
+        server, port, user = key
+        conn = None
+        try:
+            conn = smtplib.SMTP(server, port, timeout=SMTP_TIMEOUT)
+            conn.starttls()
+            conn.login(user, password)
+        except (smtplib.SMTPException, OSError):
+            if conn is not None:
+                conn.close()
+            with self._lock:
+                self._failures += 1
+                self._cooldown_until = time.monotonic() + min(SMTP_MAX_BACKOFF_SECONDS, 2 ** self._failures)
+            raise
+        
+        with self._lock:
+            self._failures = 0
+            self._cooldown_until = 0.0
+        return PooledSMTP(conn)
+    
+    def _is_alive(self, conn: PooledSMTP) -> bool:
+        if conn.closed:
+            return False
+        # A connection used moments ago is assumed alive, saving a round-trip per email
+        if time.monotonic() - conn.last_used < SMTP_NOOP_AFTER_SECONDS:
+            return True
+        try:
+            return conn.noop()[0] == 250
+        except Exception:
+            return False
+    
+    def _checkout(self, key: Tuple[str, int, str]) -> Optional[PooledSMTP]:
+        """Take the most recently used idle connection for key, if any."""
+        with self._lock:
+            idle = self._idle.get(key)
+            return idle.pop() if idle else None
+    
+    def _checkin(self, key: Tuple[str, int, str], conn: PooledSMTP):
+        conn.last_used = time.monotonic()
+        with self._lock:
+            self._idle.setdefault(key, []).append(conn)
+    
+    @contextmanager
+    def get_connection(self, server: Optional[str] = None, port: Optional[int] = None,
+                       user: Optional[str] = None, password: Optional[str] = None) -> Iterator[PooledSMTP]:
+        """
+        Yield a live connection, reconnecting if the cached one is gone.
+        Defaults to the SMTP_* / SENDER_* settings. A connection that raises
+        SMTPServerDisconnected is dropped so the next call reconnects.
+        Raises SMTPTemporarilyUnavailable while backing off after a failed connect.
+        """
+        key = (server or SMTP_SERVER, port or SMTP_PORT, user or SENDER_EMAIL)
+        conn = self._checkout(key)
+        while conn is not None and not self._is_alive(conn):
+            conn.close()
+            conn = self._checkout(key)
+        if conn is None:
+            conn = self._connect(key, password or SENDER_PASSWORD)
+        
+        try:
+            yield conn
+        except smtplib.SMTPServerDisconnected:
+            conn.close()
+            raise
+        finally:
+            # Connections that hit their message cap or disconnected are not reused
+            if not conn.closed:
+                self._checkin(key, conn)
+    
+    def close_all(self):
+        """Quit every idle connection."""
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+
+smtp_pool = SMTPPool()
+atexit.register(smtp_pool.close_all)
+
+
+def build_verification_body(token: str, product_url: str) -> str:
+    """Build the plain-text body of a verification email."""
+    verify_url = f"{APP_URL}?token={quote(token, safe='')}"
+    return render_template('verify.txt', verify_url=verify_url, product_url=product_url)
+
+
+def send_verification_email(email: str, token: str, product_url: str) -> bool:
+    """Send the verification email for a new subscription over the pooled connection."""
+    if not email_configured():
+        print(f"Error: Email credentials not configured", file=sys.stderr)
+        return False
+    
+    try:
+        msg = MIMEText(build_verification_body(token, product_url), 'plain')
+        msg['From'] = SENDER_EMAIL
+        msg['To'] = email
+        msg['Subject'] = VERIFY_SUBJECT
+        
+        with smtp_pool.get_connection() as server:
+            server.send_message(msg)
+        return True
+    except Exception as e:
+        print(f"❌ Error sending verification email to {email}: {e}", file=sys.stderr)
+        return False
+
+
+_mail_executor: Optional[ThreadPoolExecutor] = None
+_mail_executor_lock = threading.Lock()
+
+
+def get_mail_executor() -> ThreadPoolExecutor:
+    """Get the shared background executor for sending emails, starting it on first use."""
+    global _mail_executor
+    with _mail_executor_lock:
+        if _mail_executor is None:
+            _mail_executor = ThreadPoolExecutor(max_workers=MAIL_WORKERS, thread_name_prefix='mailer')
+            # Registered after smtp_pool.close_all, so queued emails go out before the pool closes
+            atexit.register(_mail_executor.shutdown, wait=True)
+        return _mail_executor
+
+
+def send_verification_email_async(email: str, token: str, product_url: str) -> Future:
+    """
+    Queue a verification email and return at once, so a web request doesn't wait on SMTP.
+    The returned future resolves to send_verification_email's result.
+    """
+    return get_mail_executor().submit(send_verification_email, email, token, product_url)
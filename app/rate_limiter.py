@@ -6,32 +6,8 @@ from typing import Optional, Tuple
 from datetime import datetime, timedelta
 from collections import defaultdict
 
-try:
-    from supabase import create_client, Client
-except ImportError:
-    raise ImportError("supabase package is required. Install with: pip install supabase")
-
-
-def get_supabase_client():
-    """Get Supabase client. Raises error if not configured."""
-    url = os.getenv('SUPABASE_URL')
-    key = os.getenv('SUPABASE_KEY')
-    
-    try:
-        import streamlit as st
-        if hasattr(st, 'secrets'):
-            url = url or st.secrets.get('SUPABASE_URL')
-            key = key or st.secrets.get('SUPABASE_KEY')
-    except:
-        pass
-    
-    if not url or not key:
-        raise ValueError(
-            "Supabase not configured. Please set SUPABASE_URL and SUPABASE_KEY "
-            "as environment variables or in Streamlit secrets."
-        )
-    
-    return create_client(url, key)
+# Share the cached Supabase client from db
+from db import get_supabase_client
 
 MAX_SUBSCRIPTIONS_PER_EMAIL = int(os.getenv('MAX_SUBSCRIPTIONS_PER_EMAIL', '50'))
 MAX_ATTEMPTS_PER_EMAIL_PER_HOUR = int(os.getenv('MAX_ATTEMPTS_PER_EMAIL_PER_HOUR', '10'))
@@ -5,96 +5,309 @@ Runs periodically to check stock for all verified subscriptions and send notific
 Can be run as a standalone script or as a background service
 """
 
-import json
 import os
 import sys
 import time
-import hashlib
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from typing import Dict, List, Set, Tuple, Optional, Iterable
 from dotenv import load_dotenv
 import smtplib
 from email.mime.text import MIMEText
 
+# Loaded before the app imports, which read their settings at import time
+load_dotenv()
+
 # Add app directory to path for imports
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
-from scraper import check_stock_status
-
-load_dotenv()
+from scraper import check_stock_status_batch, check_page_changed
 
 # Import database functions (uses Supabase)
-from db import load_subscriptions, save_subscriptions, load_state, save_state, save_stock_history
+from db import load_active_subscriptions, mark_notified, load_states, save_states, save_stock_history_batch
+from mailer import SENDER_EMAIL, SMTP_MAX_RECIPIENTS, email_configured, render_template, smtp_pool
+
+# Max number of browsers scraping products at the same time
+MAX_CONCURRENT_CHECKS = int(os.getenv('MAX_CONCURRENT_CHECKS', '4'))
+
+# Skip scraping products whose page answers a conditional request with 304 Not Modified.
+# Only states read from the page HTML keep validators; a rendered page can change while its HTML doesn't.
+SKIP_UNCHANGED_PAGES = os.getenv('SKIP_UNCHANGED_PAGES', 'true').lower() in ('1', 'true', 'yes')
+
+
+def _stock_items(items: List) -> Tuple[Tuple[str, Optional[str]], ...]:
+    """Keep the (color, size) pairs of a change list."""
+    return tuple(item for item in items if isinstance(item, tuple) and len(item) == 2)
+
 
+def build_notification_body(product_name: str, product_url: str,
+                            back_in_stock: List, out_of_stock: List) -> str:
+    """Build the plain-text body of a stock notification email."""
+    return render_template('stock_alert.txt',
+                           product_name=product_name,
+                           product_url=product_url,
+                           back_in_stock=_stock_items(back_in_stock),
+                           out_of_stock=_stock_items(out_of_stock),
+                           checked_at=datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
 
-def send_stock_notification(email: str, product_name: str, product_url: str,
-                           back_in_stock: List, out_of_stock: List):
-    """Send stock notification email."""
+
+def send_stock_notification_bulk(server: smtplib.SMTP, emails: List[str], product_name: str, product_url: str,
+                                back_in_stock: List, out_of_stock: List, body: Optional[str] = None) -> List[str]:
+    """
+    Send one stock notification to several subscribers in a single message, all as BCC.
+    Returns the addresses the server accepted.
+    Raises smtplib.SMTPServerDisconnected so the caller can reconnect and retry.
+    """
     try:
-        sender = os.getenv('SENDER_EMAIL')
-        password = os.getenv('SENDER_PASSWORD')
-        smtp_server = os.getenv('SMTP_SERVER', 'smtp.gmail.com')
-        smtp_port = int(os.getenv('SMTP_PORT', '587'))
+        if body is None:
+            body = build_notification_body(product_name, product_url, back_in_stock, out_of_stock)
+        
+        msg = MIMEText(body, 'plain')
+        msg['From'] = SENDER_EMAIL
+        msg['To'] = 'undisclosed-recipients:;'
+        msg['Subject'] = f"🎉 Arc'teryx {product_name} Stock Alert!"
         
-        if not all([sender, password]):
-            print(f"Error: Email credentials not configured", file=sys.stderr)
-            return False
+        # Recipients only travel in the envelope, so subscribers don't see each other
+        refused = server.sendmail(SENDER_EMAIL, emails, msg.as_string())
+        for email, error in refused.items():
+            print(f"❌ Error sending notification to {email}: {error}", file=sys.stderr)
+        
+        sent = [email for email in emails if email not in refused]
+        print(f"✅ Notification sent to {len(sent)} subscriber(s) for {product_name}")
+        return sent
+    except smtplib.SMTPServerDisconnected:
+        raise
+    except Exception as e:
+        print(f"❌ Error sending notification to {len(emails)} subscriber(s): {e}", file=sys.stderr)
+        return []
+
+
+def _send_with_retry(send, *args):
+    """Call send(server, *args) over the pooled connection, reconnecting once if it dropped."""
+    try:
+        with smtp_pool.get_connection() as server:
+            return send(server, *args)
+    except smtplib.SMTPServerDisconnected:
+        # The pool discarded the dead connection, so this opens a fresh one
+        with smtp_pool.get_connection() as server:
+            return send(server, *args)
+
+
+def send_notifications(changes: List[Dict]) -> Tuple[List[Dict], Set[str]]:
+    """
+    Send all stock notifications for this pass over the pooled SMTP connection.
+    Subscribers of the same product share one message, up to SMTP_MAX_RECIPIENTS per message.
+    Returns the subscriptions that were notified, and the URLs of products with a message
+    that couldn't be handed to the SMTP server.
+    """
+    if not changes:
+        return [], set()
+    
+    if not email_configured():
+        print(f"Error: Email credentials not configured", file=sys.stderr)
+        return [], set()
+    
+    batch_size = max(1, SMTP_MAX_RECIPIENTS)
+    notified = []
+    failed = set()
+    for change in changes:
+        print(f"\n📧 Sending notifications for {change['product_name']}...")
+        # Every subscriber of a product gets the same body, so build it once
+        body = build_notification_body(change['product_name'], change['product_url'],
+                                       change['back_in_stock'], change['out_of_stock'])
+        subs = change['subs']
+        sent_count = 0
+        for start in range(0, len(subs), batch_size):
+            batch = subs[start:start + batch_size]
+            try:
+                sent = set(_send_with_retry(send_stock_notification_bulk, [sub['email'] for sub in batch],
+                                            change['product_name'], change['product_url'],
+                                            change['back_in_stock'], change['out_of_stock'], body))
+            except Exception as e:
+                # Keep going: the pool reconnects (or backs off) for the next batch
+                print(f"❌ Error connecting to SMTP server: {e}", file=sys.stderr)
+                failed.add(change['product_url'])
+                continue
+            batch_notified = [sub for sub in batch if sub['email'] in sent]
+            notified.extend(batch_notified)
+            sent_count += len(batch_notified)
+        print(f"   ✅ Notifications sent to {sent_count} subscriber(s)")
+    
+    return notified, failed
+
+
+def _flatten_stock(stock: Dict, has_sizes: bool) -> Dict[Tuple[str, Optional[str]], bool]:
+    """Flatten stock data into {(color, size): in_stock}, using None as the size for color-only products."""
+    if has_sizes:
+        return {(color, size): in_stock
+                for color, sizes_stock in stock.items()
+                for size, in_stock in sizes_stock.items()}
+    return {(color, None): in_stock for color, in_stock in stock.items()}
+
+
+def diff_stock(previous: Dict, current: Dict, has_sizes: bool) -> Tuple[List, List]:
+    """
+    Compare two stock snapshots using set operations.
+    Returns (back_in_stock, out_of_stock) lists of (color, size) tuples, in page order.
+    Only combinations present in both snapshots count as changes.
+    """
+    old = _flatten_stock(previous, has_sizes)
+    new = _flatten_stock(current, has_sizes)
+    
+    old_in = {key for key, in_stock in old.items() if in_stock}
+    new_in = {key for key, in_stock in new.items() if in_stock}
+    tracked = old.keys() & new.keys()
+    
+    back = (new_in - old_in) & tracked
+    gone = (old_in - new_in) & tracked
+    
+    return [key for key in new if key in back], [key for key in new if key in gone]
+
+
+def process_product(product_url: str, subs: List[Dict], previous_state: Dict,
+                    stock_result: Tuple[Optional[Dict], Optional[bool], Optional[str]],
+                    validators: Tuple[Optional[str], Optional[str]] = (None, None)) -> Dict:
+    """
+    Work out what changed for a single product since the last check.
+    stock_result is the (stock_data, has_sizes, product_name) tuple from the scraper,
+    validators the (etag, last_modified) response headers to store with the new state,
+    or (None, None) if the stock wasn't read from the page HTML.
+    Returns a dict with the stock history rows to record ('history'), the new
+    stock_state row ('state') and the stock change to notify subscribers of ('change').
+    """
+    result = {'history': [], 'state': None, 'change': None}
+    
+    print(f"\n📦 Checking: {product_url}")
+    print(f"   Subscribers: {len(subs)}")
+    
+    try:
+        stock_data, has_sizes, product_name = stock_result
         
-        body = f"Arc'teryx {product_name} - Stock Status Update\n\n"
+        if stock_data is None:
+            print(f"   ⚠️  Could not check stock status")
+            return result
         
-        if back_in_stock:
-            body += "🎉 BACK IN STOCK:\n"
-            for item in back_in_stock:
-                if isinstance(item, tuple) and len(item) == 2:
-                    color, size = item
-                    if size:
-                        body += f"  ✅ {color} - Size {size}\n"
-                    else:
-                        body += f"  ✅ {color}\n"
-            body += "\n"
+        product_name = product_name or subs[0].get('product_name', 'Product')
         
-        if out_of_stock:
-            body += "❌ NOW OUT OF STOCK:\n"
-            for item in out_of_stock:
-                if isinstance(item, tuple) and len(item) == 2:
-                    color, size = item
-                    if size:
-                        body += f"  ❌ {color} - Size {size}\n"
-                    else:
-                        body += f"  ❌ {color}\n"
+        # Determine stock changes
+        if has_sizes:
+            previous = previous_state.get('color_size_stock', {})
+        else:
+            previous = previous_state.get('color_stock', {})
+        back_in_stock, out_of_stock = diff_stock(previous, stock_data, has_sizes)
         
-        body += f"\nProduct URL: {product_url}\n"
-        body += f"Checked at: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n"
+        # New state, saved in bulk with the other products' states
+        result['state'] = {
+            'product_url': product_url,
+            'last_checked': datetime.now().isoformat(),
+            'product_name': product_name,
+            'has_sizes': bool(has_sizes),
+            'color_stock': previous_state.get('color_stock', {}) if has_sizes else stock_data,
+            'color_size_stock': stock_data if has_sizes else previous_state.get('color_size_stock', {}),
+            'etag': validators[0],
+            'last_modified': validators[1]
+        }
         
-        if back_in_stock:
-            body += "\nHurry and get yours before it sells out again!\n"
+        # Record items that came back in stock
+        now_iso = datetime.now().isoformat()
+        result['history'] = [
+            {
+                'product_url': product_url,
+                'product_name': product_name,
+                'color': color,
+                'size': size,
+                'came_back_in_stock_at': now_iso
+            }
+            for color, size in back_in_stock
+        ]
         
-        msg = MIMEText(body, 'plain')
-        msg['From'] = sender
-        msg['To'] = email
-        msg['Subject'] = f"🎉 Arc'teryx {product_name} Stock Alert!"
+        # Queue notifications if there are changes
+        if back_in_stock or out_of_stock:
+            print(f"   📧 Stock changes detected! Queued notifications for {len(subs)} subscriber(s)")
+            result['change'] = {
+                'product_url': product_url,
+                'product_name': product_name,
+                'back_in_stock': back_in_stock,
+                'out_of_stock': out_of_stock,
+                'subs': subs
+            }
+        else:
+            print(f"   ℹ️  No stock changes detected")
         
-        server = smtplib.SMTP(smtp_server, smtp_port)
-        server.starttls()
-        server.login(sender, password)
-        server.send_message(msg)
-        server.quit()
+        return result
         
-        print(f"✅ Notification sent to {email} for {product_name}")
-        return True
     except Exception as e:
-        print(f"❌ Error sending notification to {email}: {e}", file=sys.stderr)
-        return False
+        print(f"   ❌ Error checking product: {e}", file=sys.stderr)
+        import traceback
+        traceback.print_exc(file=sys.stderr)
+        return result
 
 
-def check_all_subscriptions():
-    """Check stock for all verified subscriptions and send notifications."""
-    subscriptions = load_subscriptions()
+def find_changed_pages(product_urls: List[str], prev_states: Dict[str, Dict]) -> Dict[str, Tuple]:
+    """
+    Send a conditional HEAD request for every product.
+    Returns a dict mapping each URL to (changed, etag, last_modified).
+    """
+    if not SKIP_UNCHANGED_PAGES or not product_urls:
+        return {url: (True, None, None) for url in product_urls}
     
-    # Filter to only verified, active subscriptions
-    active_subs = {
-        key: sub for key, sub in subscriptions.items()
-        if sub.get('verified', False) and sub.get('active', True)
+    def check(url: str) -> Tuple:
+        state = prev_states.get(url) or {}
+        # Without a saved state, a 304 would leave us nothing to compare against
+        if not state.get('last_checked'):
+            changed, etag, last_modified = check_page_changed(url)
+            return True, etag, last_modified
+        return check_page_changed(url, state.get('etag'), state.get('last_modified'))
+    
+    with ThreadPoolExecutor(max_workers=min(16, len(product_urls))) as executor:
+        return dict(zip(product_urls, executor.map(check, product_urls)))
+
+
+def _unchanged_state(product_url: str, state: Dict, validators: Tuple[Optional[str], Optional[str]]) -> Dict:
+    """The stock_state row for a product whose page hasn't changed: same stock, new last_checked."""
+    return {
+        'product_url': product_url,
+        'last_checked': datetime.now().isoformat(),
+        'product_name': state.get('product_name'),
+        'has_sizes': bool(state.get('has_sizes')),
+        'color_stock': state.get('color_stock', {}),
+        'color_size_stock': state.get('color_size_stock', {}),
+        'etag': validators[0],
+        'last_modified': validators[1]
     }
+
+
+def check_products(products: Dict[str, List[Dict]], prev_states: Dict[str, Dict]) -> List[Dict]:
+    """
+    Scrape every product whose page changed, then work out stock changes for each.
+    Returns the per-product results from process_product, plus a refreshed state for each skipped product.
+    """
+    pages = find_changed_pages(list(products), prev_states)
+    to_scrape = [url for url in products if pages[url][0]]
+    skipped = [url for url in products if not pages[url][0]]
+    
+    if skipped:
+        print(f"Skipping {len(skipped)} product(s) whose page has not changed since the last check")
+    
+    from_html = set()
+    stock_results = check_stock_status_batch(to_scrape, headless=True, max_workers=MAX_CONCURRENT_CHECKS,
+                                             from_html=from_html)
+    results = [
+        process_product(product_url, products[product_url], prev_states[product_url],
+                        stock_results.get(product_url, (None, None, None)),
+                        pages[product_url][1:] if product_url in from_html else (None, None))
+        for product_url in to_scrape
+    ]
+    results.extend(
+        {'history': [], 'state': _unchanged_state(url, prev_states[url], pages[url][1:]), 'change': None}
+        for url in skipped
+    )
+    return results
+
+
+def check_all_subscriptions():
+    """Check stock for all verified subscriptions and send notifications."""
+    # Only verified subscriptions are fetched, filtered by Supabase
+    active_subs = load_active_subscriptions()
     
     if not active_subs:
         print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] No active subscriptions to check")
@@ -112,99 +325,45 @@ def check_all_subscriptions():
     
     print(f"Found {len(products)} unique product(s) to check")
     
-    # Check each product
-    for product_url, subs in products.items():
-        print(f"\n📦 Checking: {product_url}")
-        print(f"   Subscribers: {len(subs)}")
-        
+    # Load previous stock state for every product in one query
+    prev_states = load_states(list(products))
+    
+    # Check products concurrently
+    results = check_products(products, prev_states)
+    
+    # Send every notification over one SMTP connection
+    notified, failed = send_notifications([result['change'] for result in results if result['change']])
+    
+    # Products whose alerts didn't go out keep their old state, so the change is notified next pass
+    if failed:
+        print(f"⚠️  Keeping the previous state of {len(failed)} product(s) to retry their notifications")
+        results = [result for result in results
+                   if result['state'] is None or result['state']['product_url'] not in failed]
+    
+    # Save the new state of every checked product in one upsert
+    try:
+        save_states([result['state'] for result in results if result['state']])
+    except Exception as e:
+        print(f"⚠️  Error saving stock state: {e}", file=sys.stderr)
+    
+    # Record all back-in-stock events from this pass in one insert
+    history_batch = [row for result in results for row in result['history']]
+    if history_batch:
         try:
-            # Check current stock
-            stock_data, has_sizes, product_name = check_stock_status(product_url, headless=True)
-            
-            if stock_data is None:
-                print(f"   ⚠️  Could not check stock status")
-                continue
-            
-            product_name = product_name or subs[0].get('product_name', 'Product')
-            previous_state = load_state(product_url)
-            
-            # Determine stock changes
-            back_in_stock = []
-            out_of_stock = []
-            
-            if has_sizes:
-                previous = previous_state.get('color_size_stock', {})
-                for color, sizes_stock in stock_data.items():
-                    prev_sizes = previous.get(color, {})
-                    for size, is_in_stock in sizes_stock.items():
-                        was_in_stock = prev_sizes.get(size)
-                        if was_in_stock is not None:
-                            if not was_in_stock and is_in_stock:
-                                back_in_stock.append((color, size))
-                                # Record in stock history
-                                try:
-                                    save_stock_history(product_url, product_name, color, size)
-                                except Exception as e:
-                                    print(f"   ⚠️  Error saving stock history: {e}", file=sys.stderr)
-                            elif was_in_stock and not is_in_stock:
-                                out_of_stock.append((color, size))
-                
-                # Save new state
-                save_state(product_url, color_size_stock=stock_data, 
-                          has_sizes=True, product_name=product_name)
-            else:
-                previous = previous_state.get('color_stock', {})
-                for color, is_in_stock in stock_data.items():
-                    was_in_stock = previous.get(color)
-                    if was_in_stock is not None:
-                        if not was_in_stock and is_in_stock:
-                            back_in_stock.append((color, None))
-                            # Record in stock history
-                            try:
-                                save_stock_history(product_url, product_name, color, None)
-                            except Exception as e:
-                                print(f"   ⚠️  Error saving stock history: {e}", file=sys.stderr)
-                        elif was_in_stock and not is_in_stock:
-                            out_of_stock.append((color, None))
-                
-                # Save new state
-                save_state(product_url, color_stock=stock_data, 
-                          has_sizes=False, product_name=product_name)
-            
-            # Send notifications if there are changes
-            if back_in_stock or out_of_stock:
-                print(f"   📧 Stock changes detected! Sending notifications...")
-                for sub in subs:
-                    send_stock_notification(
-                        sub['email'],
-                        product_name,
-                        product_url,
-                        back_in_stock,
-                        out_of_stock
-                    )
-                    # Update last_notified timestamp
-                    sub['last_notified'] = datetime.now().isoformat()
-                    subscriptions[get_subscription_key(sub['email'], product_url)] = sub
-                
-                save_subscriptions(subscriptions)
-                print(f"   ✅ Notifications sent to {len(subs)} subscriber(s)")
-            else:
-                print(f"   ℹ️  No stock changes detected")
-            
+            save_stock_history_batch(history_batch)
+        except Exception as e:
+            print(f"⚠️  Error saving stock history: {e}", file=sys.stderr)
+    
+    # Persist last_notified timestamps for the notified subscriptions only
+    if notified:
+        try:
+            mark_notified([sub['id'] for sub in notified])
         except Exception as e:
-            print(f"   ❌ Error checking product: {e}", file=sys.stderr)
-            import traceback
-            traceback.print_exc(file=sys.stderr)
-            continue
+            print(f"⚠️  Error updating last_notified: {e}", file=sys.stderr)
     
     print(f"\n[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] Check complete!")
 
 
-def get_subscription_key(email: str, product_url: str) -> str:
-    """Generate a unique key for a subscription."""
-    return hashlib.md5(f"{email}:{product_url}".encode()).hexdigest()
-
-
 def run_continuous(interval_minutes: int = 15):
     """Run checks continuously at specified interval."""
     print(f"🚀 Starting continuous stock monitor (checking every {interval_minutes} minutes)")
@@ -231,6 +390,9 @@ def main():
     
     args = parser.parse_args()
     
+    if not email_configured():
+        print("⚠️  SENDER_EMAIL / SENDER_PASSWORD not set, notifications will not be sent", file=sys.stderr)
+    
     if args.once:
         # Run once (for cron jobs)
         check_all_subscriptions()
@@ -8,63 +8,373 @@ from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.chrome.options import Options
-from selenium.common.exceptions import TimeoutException, NoSuchElementException
+from selenium.common.exceptions import TimeoutException
+import atexit
+import json
 import os
+import queue
+import re
 import sys
-import time
-from typing import Optional, Dict, List, Tuple
+import threading
+import urllib.error
+import urllib.request
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+from typing import Optional, Dict, List, Set, Tuple
+from urllib.parse import urlsplit
 
+USER_AGENT = 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
 
-def setup_driver(headless: bool = True):
-    """Setup and return a Chrome driver."""
+# Try reading stock from the page's embedded JSON before starting a browser
+HTTP_FIRST = os.getenv('SCRAPER_HTTP_FIRST', 'true').lower() in ('1', 'true', 'yes')
+
+# Resources the scraper never reads; blocking them cuts page bytes and load time.
+# Stylesheets are kept because clicks need the real layout.
+BLOCKED_URL_PATTERNS = [
+    '*.png', '*.jpg', '*.jpeg', '*.gif', '*.webp', '*.avif', '*.svg', '*.ico',
+    '*.woff', '*.woff2', '*.ttf', '*.otf',
+    '*.mp4', '*.webm',
+]
+
+# Third-party analytics, tag manager and A/B testing hosts; their scripts hold up
+# DOMContentLoaded and nothing the scraper reads comes from them
+BLOCK_TRACKERS = os.getenv('SCRAPER_BLOCK_TRACKERS', 'true').lower() in ('1', 'true', 'yes')
+TRACKER_URL_PATTERNS = [
+    '*googletagmanager.com*', '*google-analytics.com*', '*doubleclick.net*', '*googleadservices.com*',
+    '*connect.facebook.net*', '*analytics.tiktok.com*', '*bat.bing.com*', '*ct.pinterest.com*',
+    '*hotjar.com*', '*optimizely.com*', '*cdn.segment.com*', '*quantummetric.com*',
+]
+
+# host:port of an already running Chrome started with --remote-debugging-port (see scripts/start_chrome.sh)
+CHROME_DEBUGGER_ADDRESS = os.getenv('ARC_CHROME_DEBUGGER') or None
+
+_NEXT_DATA_RE = re.compile(r'<script[^>]*id="__NEXT_DATA__"[^>]*>(.*?)</script>', re.DOTALL)
+
+
+def setup_driver(headless: bool = True, attach_to: Optional[str] = None):
+    """
+    Setup and return a Chrome driver.
+    With attach_to ('host:port'), connect to a running Chrome instead of launching one;
+    that browser's own launch flags apply, so headless and the other arguments are skipped.
+    """
     chrome_options = Options()
     
-    # Explicitly set Chrome binary path on Mac
-    chrome_binary_path = "/Applications/Google Chrome.app/Contents/MacOS/Google Chrome"
-    if os.path.exists(chrome_binary_path):
-        chrome_options.binary_location = chrome_binary_path
-    
-    if headless:
-        chrome_options.add_argument('--headless=new')
-    chrome_options.add_argument('--no-sandbox')
-    chrome_options.add_argument('--disable-dev-shm-usage')
-    chrome_options.add_argument('--disable-gpu')
-    chrome_options.add_argument('--disable-blink-features=AutomationControlled')
-    chrome_options.add_argument('--window-size=1920,1080')
-    chrome_options.add_argument('user-agent=Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36')
-    chrome_options.page_load_strategy = 'eager'
+    if attach_to:
+        chrome_options.add_experimental_option('debuggerAddress', attach_to)
+    else:
+        # Explicitly set Chrome binary path on Mac
+        chrome_binary_path = "/Applications/Google Chrome.app/Contents/MacOS/Google Chrome"
+        if os.path.exists(chrome_binary_path):
+            chrome_options.binary_location = chrome_binary_path
+        
+        if headless:
+            chrome_options.add_argument('--headless=new')
+        chrome_options.add_argument('--no-sandbox')
+        chrome_options.add_argument('--disable-dev-shm-usage')
+        chrome_options.add_argument('--disable-gpu')
+        chrome_options.add_argument('--disable-blink-features=AutomationControlled')
+        chrome_options.add_argument('--window-size=1920,1080')
+        chrome_options.add_argument(f'user-agent={USER_AGENT}')
+        chrome_options.add_argument('--blink-settings=imagesEnabled=false')
+        chrome_options.add_experimental_option('prefs', {
+            'profile.managed_default_content_settings.images': 2,
+            'profile.default_content_setting_values.notifications': 2,
+        })
+    
+    # driver.get returns at once; callers wait for the widgets they read (see _check_one)
+    chrome_options.page_load_strategy = 'none'
     
     try:
         driver = webdriver.Chrome(options=chrome_options)
         driver.set_page_load_timeout(30)
-        driver.implicitly_wait(3)
+        driver.set_script_timeout(5)
+        # No implicit wait: missing-element probes should fail at once; WebDriverWait is used where waiting matters
+        driver.implicitly_wait(0)
+        try:
+            driver.execute_cdp_cmd('Network.enable', {})
+            blocked = BLOCKED_URL_PATTERNS + (TRACKER_URL_PATTERNS if BLOCK_TRACKERS else [])
+            driver.execute_cdp_cmd('Network.setBlockedURLs', {'urls': blocked})
+        except Exception as e:
+            print(f"Could not block page resources: {e}", file=sys.stderr)
         return driver
     except Exception as e:
         print(f"Error setting up Chrome driver: {e}", file=sys.stderr, flush=True)
         return None
 
 
+def check_page_changed(product_url: str, etag: Optional[str] = None,
+                       last_modified: Optional[str] = None) -> Tuple[bool, Optional[str], Optional[str]]:
+    """
+    Ask the server whether a product page changed, using a conditional HEAD request.
+    Returns (changed, etag, last_modified). Falls back to changed=True whenever the
+    server doesn't send validators or the request fails, so the page gets scraped.
+    """
+    headers = {'User-Agent': USER_AGENT}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+    
+    request = urllib.request.Request(product_url, headers=headers, method='HEAD')
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            return True, response.headers.get('ETag'), response.headers.get('Last-Modified')
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            return False, etag, last_modified
+        return True, None, None
+    except Exception:
+        return True, None, None
+
+
+def _decode_nested(value):
+    """Yield value and, if it is a JSON-encoded string, its decoded content."""
+    yield value
+    if isinstance(value, str) and value[:1] in ('{', '['):
+        try:
+            yield json.loads(value)
+        except ValueError:
+            pass
+
+
+# Keys the page's own product sits under, as opposed to related or recommended products
+_PRODUCT_KEYS = ('product', 'productData')
+_PRODUCT_URL_KEYS = ('slug', 'url', 'productUrl', 'canonicalUrl', 'uri')
+
+
+def _url_slug(url: str) -> str:
+    """Last path segment of a URL or path, e.g. 'beta-jacket' for .../shop/mens/beta-jacket?x=1."""
+    return urlsplit(url).path.rstrip('/').rsplit('/', 1)[-1].lower()
+
+
+def _is_product_at(candidate: Dict, slug: str) -> bool:
+    """True if the candidate object names the page's product in one of its slug/URL fields."""
+    for key in _PRODUCT_URL_KEYS:
+        value = candidate.get(key)
+        if isinstance(value, str) and value and _url_slug(value) == slug:
+            return True
+    return False
+
+
+def _find_product(data, product_url: str) -> Optional[Dict]:
+    """
+    Find the page's product in its page data: an object with a list of variants whose
+    slug/URL matches product_url. Searched breadth-first, preferring one under a 'product' key.
+    """
+    slug = _url_slug(product_url)
+    if not slug:
+        return None
+    
+    found = None
+    nodes = deque([(None, data)])
+    while nodes:
+        key, node = nodes.popleft()
+        for value in _decode_nested(node):
+            if isinstance(value, dict):
+                variants = value.get('variants')
+                if (isinstance(variants, list) and variants and isinstance(variants[0], dict)
+                        and _is_product_at(value, slug)):
+                    if key in _PRODUCT_KEYS:
+                        return value
+                    found = found or value
+                nodes.extend(value.items())
+            elif isinstance(value, list):
+                nodes.extend((None, item) for item in value)
+    return found
+
+
+def _option_labels(product: Dict, *keys: str) -> Dict[str, str]:
+    """Map option IDs to labels for colour/size options, e.g. product['colourOptions']['options']."""
+    for key in keys:
+        options = product.get(key)
+        if isinstance(options, dict):
+            options = options.get('options')
+        if isinstance(options, list):
+            # Options without an ID can't be matched to variants, so they are left out
+            return {
+                str(opt.get('value', opt.get('id'))): str(opt.get('label', opt.get('name', ''))).strip()
+                for opt in options
+                if isinstance(opt, dict) and opt.get('value', opt.get('id')) is not None
+            }
+    return {}
+
+
+def _variant_in_stock(variant: Dict) -> Optional[bool]:
+    """Read a variant's stock flag, or None if it has none we recognise."""
+    for key in ('inStock', 'isInStock', 'available', 'isAvailable'):
+        if isinstance(variant.get(key), bool):
+            return variant[key]
+    for key in ('inventory', 'stock', 'quantity'):
+        if isinstance(variant.get(key), (int, float)) and not isinstance(variant.get(key), bool):
+            return variant[key] > 0
+    status = variant.get('stockStatus') or variant.get('availability')
+    if isinstance(status, str):
+        return status.lower().replace('_', '').replace(' ', '') in ('instock', 'lowstock', 'available')
+    return None
+
+
+def _declares_no_options(product: Dict, *keys: str) -> bool:
+    """True if the product lists one of the option keys, but with no options in it."""
+    for key in keys:
+        options = product.get(key)
+        if isinstance(options, dict):
+            options = options.get('options')
+        if isinstance(options, list):
+            return not options
+    return False
+
+
+def parse_product_json(html: str, product_url: str) -> Optional[Tuple[Dict, bool, Optional[str]]]:
+    """
+    Read stock data for product_url from its page's embedded __NEXT_DATA__ JSON.
+    Returns (stock_data, has_sizes, product_name) in the same shape as the browser
+    path, (None, None, None) if the product has no color options (the browser path
+    would find none either), or None if the page doesn't contain data we can read reliably.
+    """
+    match = _NEXT_DATA_RE.search(html)
+    if not match:
+        return None
+    try:
+        product = _find_product(json.loads(match.group(1)), product_url)
+    except ValueError:
+        return None
+    if not product:
+        return None
+    
+    colour_labels = _option_labels(product, 'colourOptions', 'colorOptions', 'colours', 'colors')
+    size_labels = _option_labels(product, 'sizeOptions', 'sizes')
+    if not colour_labels:
+        if _declares_no_options(product, 'colourOptions', 'colorOptions', 'colours', 'colors'):
+            return None, None, None
+        return None
+    
+    stock = {}
+    for variant in product['variants']:
+        if not isinstance(variant, dict):
+            return None
+        colour_id = variant.get('colourId', variant.get('colorId'))
+        size_id = variant.get('sizeId')
+        colour = colour_labels.get(str(colour_id)) if colour_id is not None else None
+        in_stock = _variant_in_stock(variant)
+        if not colour or in_stock is None:
+            # Anything we can't interpret means the browser path should decide
+            return None
+        size = size_labels.get(str(size_id)) if size_labels and size_id is not None else None
+        if size_labels and not size:
+            return None
+        stock.setdefault(colour, {})[size] = stock.get(colour, {}).get(size, False) or in_stock
+    
+    product_name = product.get('name') or product.get('analyticsName')
+    
+    # Same size rules as get_all_sizes, so both paths report a product in the same shape
+    sizes = sorted({size.strip() for size in size_labels.values() if is_valid_size(size)}, key=get_size_sort_key)
+    if not sizes:
+        return {colour: any(by_size.values()) for colour, by_size in stock.items()}, False, product_name
+    
+    stock_data = {
+        colour: {size: by_size.get(size, False) for size in sizes}
+        for colour, by_size in stock.items()
+    }
+    return stock_data, True, product_name
+
+
+def check_stock_status_http(product_url: str) -> Optional[Tuple[Dict, bool, Optional[str]]]:
+    """
+    Check stock with a single HTTP request, without a browser.
+    Returns (stock_data, has_sizes, product_name), (None, None, None) for products
+    without color options, or None if the page data can't be used.
+    """
+    request = urllib.request.Request(product_url, headers={'User-Agent': USER_AGENT, 'Accept': 'text/html'})
+    try:
+        with urllib.request.urlopen(request, timeout=15) as response:
+            charset = response.headers.get_content_charset() or 'utf-8'
+            html = response.read().decode(charset, errors='replace')
+    except Exception as e:
+        print(f"HTTP fetch failed for {product_url}, using browser: {e}", file=sys.stderr)
+        return None
+    
+    try:
+        return parse_product_json(html, product_url)
+    except Exception as e:
+        print(f"Could not read page data for {product_url}, using browser: {e}", file=sys.stderr)
+        return None
+
+
+# DOM reads done in a single execute_script call instead of one WebDriver round-trip per element
+_ATTRIBUTE_VALUES_SCRIPT = """
+return Array.from(document.querySelectorAll(arguments[0])).map(e => e.getAttribute(arguments[1]));
+"""
+
+# Labels of the colour selector's options, or null if the selector hasn't rendered yet
+_COLOR_LABELS_SCRIPT = """
+if (!document.querySelector('fieldset.qa--colour-selector')) return null;
+return Array.from(document.querySelectorAll('fieldset.qa--colour-selector ol li[aria-label]')).map(e => e.getAttribute('aria-label'));
+"""
+
+# Size button values and texts, or null if no size list has rendered yet
+_SIZE_BUTTONS_SCRIPT = """
+const lists = Array.from(document.querySelectorAll('ol.qa--size-list, ol[data-testid="size-list"]'));
+if (!lists.length) return null;
+const buttons = sel => lists.flatMap(l => Array.from(l.querySelectorAll(sel)));
+return {
+    values: buttons('button[data-size-value]').map(b => b.getAttribute('data-size-value')),
+    texts: buttons('button[role="radio"]').map(b => b.innerText)
+};
+"""
+
+# Class-based stock state of the whole page in one read: every color option's 'no--stock'
+# flag (colour selector options first) and every size button's [value, noStock, disabled]
+_STOCK_SNAPSHOT_SCRIPT = """
+const noStock = e => (e.getAttribute('class') || '').includes('no--stock');
+const colors = new Map();
+const scan = els => {
+    for (const item of els) {
+        const name = item.getAttribute('aria-label');
+        if (colors.has(name)) continue;
+        colors.set(name, noStock(item) || Array.from(item.querySelectorAll("button, *[class*='no--stock']")).some(noStock));
+    }
+};
+scan(document.querySelectorAll('fieldset.qa--colour-selector li[aria-label]'));
+scan(document.querySelectorAll('li[aria-label]'));
+const sizes = Array.from(document.querySelectorAll(
+    'ol.qa--size-list button[data-size-value], ol[data-testid="size-list"] button[data-size-value]'
+)).map(b => [
+    (b.getAttribute('data-size-value') || '').trim(),
+    noStock(b),
+    b.disabled || b.hasAttribute('disabled')
+]);
+return {colors: Object.fromEntries(colors), sizes: sizes};
+"""
+
+
+# Labels containing any of these words are other controls, not colors
+_COLOR_FILTER_WORDS = frozenset({'select', 'choose', 'size', 'quantity', 'size0', 'size1', 'size2', 'size3', 'size4', 'size5', 'size6'})
+_WORD_RE = re.compile(r'[a-z0-9]+')
+
+
 def get_all_colors(driver) -> List[str]:
     """Extract all available color options from the page."""
     colors = []
-    filter_words = {'select', 'choose', 'size', 'quantity', 'size0', 'size1', 'size2', 'size3', 'size4', 'size5', 'size6'}
     
     try:
-        wait = WebDriverWait(driver, 10)
-        try:
-            wait.until(EC.presence_of_element_located((By.CSS_SELECTOR, "fieldset.qa--colour-selector")))
-            color_items = driver.find_elements(By.CSS_SELECTOR, "fieldset.qa--colour-selector ol li[aria-label]")
-        except TimeoutException:
-            wait.until(EC.presence_of_element_located((By.TAG_NAME, "ol")))
-            color_items = driver.find_elements(By.CSS_SELECTOR, "ol li[aria-label]")
+        # Read straight away; only wait if the colour selector hasn't rendered yet
+        labels = driver.execute_script(_COLOR_LABELS_SCRIPT)
+        if labels is None:
+            wait = WebDriverWait(driver, 10)
+            try:
+                wait.until(EC.presence_of_element_located((By.CSS_SELECTOR, "fieldset.qa--colour-selector")))
+                labels = driver.execute_script(_COLOR_LABELS_SCRIPT)
+            except TimeoutException:
+                wait.until(EC.presence_of_element_located((By.TAG_NAME, "ol")))
+                labels = driver.execute_script(_ATTRIBUTE_VALUES_SCRIPT, "ol li[aria-label]", 'aria-label')
         
         seen_colors = set()
-        for item in color_items:
-            aria_label = item.get_attribute('aria-label')
+        for aria_label in labels or []:
             if aria_label and aria_label.strip():
                 color_name = aria_label.strip()
                 color_lower = color_name.lower()
-                if not any(word in color_lower for word in filter_words):
+                if _COLOR_FILTER_WORDS.isdisjoint(_WORD_RE.findall(color_lower)):
                     if color_name not in seen_colors:
                         seen_colors.add(color_name)
                         colors.append(color_name)
@@ -76,43 +386,42 @@ def get_all_colors(driver) -> List[str]:
     return colors
 
 
+_SIZE_ORDER = ('XXS', 'XS', 'S', 'M', 'L', 'XL', 'XXL', '2X', '2XL', '3X', '3XL')
+_SIZE_INDEX = {size: i for i, size in enumerate(_SIZE_ORDER)}
+_SIZE_VARIATION_OFFSETS = {'R': 0, 'T': 100, 'S': 200}
+
+# A base size, optionally followed by a fit variation such as "M-T" (regular/tall/short)
+_SIZE_RE = re.compile(r'(%s)(?:\s*-\s*([%s]))?' % ('|'.join(_SIZE_ORDER), ''.join(_SIZE_VARIATION_OFFSETS)))
+
+
+def is_valid_size(size_str: str) -> bool:
+    """Check whether a label is a letter size we track, e.g. 'M' or 'L-T'."""
+    return _SIZE_RE.fullmatch(size_str.strip().upper()) is not None
+
+
+def get_size_sort_key(size_str: str) -> int:
+    """Sort key ordering sizes XXS..3XL, with regular/tall/short variations after each base size."""
+    match = _SIZE_RE.fullmatch(size_str.strip().upper())
+    if not match:
+        return 999 * 1000
+    base_index = _SIZE_INDEX[match.group(1)]
+    return base_index * 1000 + _SIZE_VARIATION_OFFSETS.get(match.group(2), 0)
+
+
 def get_all_sizes(driver) -> List[str]:
     """Extract all available size options from the page."""
     sizes = []
-    base_sizes = {'XXS', 'XS', 'S', 'M', 'L', 'XL', 'XXL', '2X', '2XL', '3X', '3XL'}
-    size_order = ['XXS', 'XS', 'S', 'M', 'L', 'XL', 'XXL', '2X', '2XL', '3X', '3XL']
-    size_variations = {'R', 'T', 'S'}
-    
-    def is_valid_size(size_str: str) -> bool:
-        size_upper = size_str.upper().strip()
-        if size_upper in base_sizes:
-            return True
-        if '-' in size_upper:
-            parts = size_upper.split('-')
-            if len(parts) == 2:
-                base, variation = parts[0].strip(), parts[1].strip()
-                return base in base_sizes and variation in size_variations
-        return False
-    
-    def get_size_sort_key(size_str: str) -> int:
-        size_upper = size_str.upper().strip()
-        base = size_upper.split('-')[0] if '-' in size_upper else size_upper
-        base_index = size_order.index(base) if base in size_order else 999
-        if '-' in size_upper:
-            variation = size_upper.split('-')[1].strip()
-            variation_offset = {'R': 0, 'T': 100, 'S': 200}.get(variation, 300)
-            return base_index * 1000 + variation_offset
-        return base_index * 1000
     
     try:
-        wait = WebDriverWait(driver, 5)
-        wait.until(EC.presence_of_element_located((By.CSS_SELECTOR, "ol.qa--size-list, ol[data-testid='size-list']")))
-        
-        size_buttons = driver.find_elements(By.CSS_SELECTOR, "ol.qa--size-list button[data-size-value], ol[data-testid='size-list'] button[data-size-value]")
+        # Read straight away; only wait if the size list hasn't rendered yet
+        buttons = driver.execute_script(_SIZE_BUTTONS_SCRIPT)
+        if buttons is None:
+            wait = WebDriverWait(driver, 5)
+            wait.until(EC.presence_of_element_located((By.CSS_SELECTOR, "ol.qa--size-list, ol[data-testid='size-list']")))
+            buttons = driver.execute_script(_SIZE_BUTTONS_SCRIPT) or {}
         
         seen_sizes = set()
-        for button in size_buttons:
-            size_value = button.get_attribute('data-size-value')
+        for size_value in buttons.get('values') or []:
             if size_value and size_value.strip():
                 size = size_value.strip()
                 if is_valid_size(size) and size not in seen_sizes:
@@ -120,9 +429,8 @@ def get_all_sizes(driver) -> List[str]:
                     sizes.append(size)
         
         if not sizes:
-            size_buttons = driver.find_elements(By.CSS_SELECTOR, "ol.qa--size-list button[role='radio'], ol[data-testid='size-list'] button[role='radio']")
-            for button in size_buttons:
-                text = button.text.strip()
+            for text in buttons.get('texts') or []:
+                text = (text or '').strip()
                 if is_valid_size(text) and text not in seen_sizes:
                     seen_sizes.add(text)
                     sizes.append(text)
@@ -136,81 +444,164 @@ def get_all_sizes(driver) -> List[str]:
     return sizes
 
 
+def _stock_cache(driver) -> Dict[Tuple[str, str], Optional[bool]]:
+    """
+    Class-based stock statuses for the current page state, keyed by ('color'|'size', value).
+    Filled from one snapshot script on first use and cleared by clear_stock_cache
+    whenever the page state changes (navigation or a click).
+    Options missing from the snapshot have no entry, i.e. None.
+    """
+    cache = getattr(driver, '_stock_cache', None)
+    if cache is None:
+        cache = {}
+        try:
+            snapshot = driver.execute_script(_STOCK_SNAPSHOT_SCRIPT) or {}
+        except Exception:
+            # Don't remember a failed read, so the next check retries
+            return cache
+        for name, no_stock in (snapshot.get('colors') or {}).items():
+            cache[('color', name)] = False if no_stock else None
+        for value, no_stock, disabled in snapshot.get('sizes') or []:
+            if value and ('size', value) not in cache:
+                cache[('size', value)] = False if no_stock else (True if not disabled else None)
+        driver._stock_cache = cache
+    return cache
+
+
+def clear_stock_cache(driver):
+    """Drop the stock snapshot after the page state changed."""
+    driver._stock_cache = None
+
+
 def check_color_stock_by_class(driver, color_name: str) -> Optional[bool]:
     """Check stock status by looking at the color option's class for 'no--stock'."""
-    try:
-        try:
-            color_element = driver.find_element(By.XPATH, f"//fieldset[@class='qa--colour-selector' or contains(@class, 'qa--colour-selector')]//li[@aria-label='{color_name}']")
-        except NoSuchElementException:
-            color_element = driver.find_element(By.XPATH, f"//li[@aria-label='{color_name}']")
-        
-        element_class = color_element.get_attribute('class') or ''
-        if 'no--stock' in element_class:
-            return False
-        
-        try:
-            child_buttons = color_element.find_elements(By.CSS_SELECTOR, "button, *[class*='no--stock']")
-            for child in child_buttons:
-                child_class = child.get_attribute('class') or ''
-                if 'no--stock' in child_class:
-                    return False
-        except:
-            pass
-        
-        return None
-    except Exception:
-        return None
+    return _stock_cache(driver).get(('color', color_name))
 
 
 def check_size_stock_by_class(driver, size: str) -> Optional[bool]:
-    """Check stock status by looking at the size button's class for 'no--stock'."""
+    """
+    Check stock status by looking at the size button's class: False for 'no--stock',
+    True for enabled buttons, None when the class doesn't tell.
+    """
+    return _stock_cache(driver).get(('size', size))
+
+
+def check_sizes_stock_by_class(driver) -> Dict[str, Optional[bool]]:
+    """Stock status of every size button for the selected color, by the check_size_stock_by_class rules."""
+    return {value: status for (kind, value), status in _stock_cache(driver).items() if kind == 'size'}
+
+
+# Resolves once the DOM has had no mutations for `quiet` ms, or after `timeout` ms at most
+_DOM_SETTLE_SCRIPT = """
+const done = arguments[arguments.length - 1];
+const quiet = arguments[0], timeout = arguments[1];
+let timer = null, deadline = null;
+const observer = new MutationObserver(() => { clearTimeout(timer); timer = setTimeout(finish, quiet); });
+function finish() {
+    observer.disconnect();
+    clearTimeout(timer);
+    clearTimeout(deadline);
+    done(true);
+}
+observer.observe(document.body, {subtree: true, childList: true, attributes: true, characterData: true});
+timer = setTimeout(finish, quiet);
+deadline = setTimeout(finish, timeout);
+"""
+
+
+def wait_for_dom_settle(driver, quiet_ms: int = 150, timeout_ms: int = 2000):
+    """Wait until the page stops re-rendering after an interaction, instead of sleeping a fixed time."""
     try:
-        size_button = driver.find_element(By.XPATH, f"//ol[@class='qa--size-list' or @data-testid='size-list']//button[@data-size-value='{size}']")
-        button_class = size_button.get_attribute('class') or ''
-        if 'no--stock' in button_class:
-            return False
-        if not size_button.get_attribute('disabled'):
-            return True
-        return None
+        driver.execute_async_script(_DOM_SETTLE_SCRIPT, quiet_ms, timeout_ms)
     except Exception:
-        return None
+        pass
+
+
+# Every button that could be Add to Cart / Notify Me, as [aria-label, text, disabled], in document order
+_CART_BUTTONS_SCRIPT = """
+return Array.from(document.querySelectorAll('button'))
+    .map(b => [(b.getAttribute('aria-label') || '').toLowerCase(), (b.innerText || '').toLowerCase().trim(), b.disabled])
+    .filter(([label, text]) => /add to cart|notify me/.test(label + ' ' + text));
+"""
 
 
 def check_button_for_stock(driver) -> Optional[bool]:
     """Check the Add to Cart button text to determine stock status."""
     try:
-        buttons = driver.find_elements(By.CSS_SELECTOR, "button[aria-label], button[type='submit'], button")
-        for btn in buttons:
-            aria_label = (btn.get_attribute('aria-label') or '').lower()
-            if 'add to cart' in aria_label:
-                if not btn.get_attribute('disabled'):
-                    return True
-            if 'notify me' in aria_label:
-                return False
-            
-            text = btn.text.lower().strip()
-            if 'add to cart' in text:
-                if not btn.get_attribute('disabled'):
-                    return True
-            if 'notify me' in text:
-                return False
-        return None
-    except Exception as e:
+        buttons = driver.execute_script(_CART_BUTTONS_SCRIPT) or []
+    except Exception:
         return None
+    
+    for aria_label, text, disabled in buttons:
+        if 'add to cart' in aria_label and not disabled:
+            return True
+        if 'notify me' in aria_label:
+            return False
+        if 'add to cart' in text and not disabled:
+            return True
+        if 'notify me' in text:
+            return False
+    return None
+
+
+# Finds the first element matching one of the selectors whose attribute equals the value,
+# scrolls it into view and returns it, all in one round-trip
+_FIND_AND_SCROLL_SCRIPT = """
+const [targets, value] = arguments;
+for (const [selector, attribute] of targets) {
+    const matches = attribute
+        ? e => e.getAttribute(attribute) === value
+        : e => (e.innerText || '').trim() === value;
+    const el = Array.from(document.querySelectorAll(selector)).find(matches);
+    if (el) {
+        el.scrollIntoView({block: 'center'});
+        return el;
+    }
+}
+return null;
+"""
+
+# (selector, attribute to match) pairs tried in order; a None attribute matches the element's text
+_COLOR_OPTION_TARGETS = [
+    ('fieldset.qa--colour-selector li[aria-label]', 'aria-label'),
+    ('li[aria-label]', 'aria-label'),
+]
+_SIZE_BUTTON_TARGETS = [
+    ('ol.qa--size-list button[data-size-value], ol[data-testid="size-list"] button[data-size-value]', 'data-size-value'),
+    ('ol.qa--size-list button[role="radio"], ol[data-testid="size-list"] button[role="radio"]', None),
+]
+
+
+def wait_for_interactive(driver, timeout: int = 10):
+    """
+    Wait until the page's scripts have run (readyState past 'loading') before the first click,
+    since pages load without blocking and the widgets render before they respond.
+    """
+    if getattr(driver, '_page_interactive', True):
+        return
+    try:
+        WebDriverWait(driver, timeout).until(lambda d: d.execute_script("return document.readyState") != 'loading')
+    except TimeoutException:
+        pass
+    driver._page_interactive = True
+
+
+def _find_and_scroll(driver, targets: List[Tuple[str, Optional[str]]], value: str):
+    """Return the first element matching value for one of the targets, scrolled into view, or None."""
+    return driver.execute_script(_FIND_AND_SCROLL_SCRIPT, [list(target) for target in targets], value)
 
 
 def click_color_option(driver, color_name: str) -> bool:
     """Click on a color option and wait for page to update."""
     try:
-        try:
-            color_element = driver.find_element(By.XPATH, f"//fieldset[@class='qa--colour-selector' or contains(@class, 'qa--colour-selector')]//li[@aria-label='{color_name}']")
-        except NoSuchElementException:
-            color_element = driver.find_element(By.XPATH, f"//li[@aria-label='{color_name}']")
+        wait_for_interactive(driver)
+        color_element = _find_and_scroll(driver, _COLOR_OPTION_TARGETS, color_name)
+        if color_element is None:
+            return False
         
-        driver.execute_script("arguments[0].scrollIntoView({block: 'center'});", color_element)
-        time.sleep(0.3)
         color_element.click()
-        time.sleep(1)
+        clear_stock_cache(driver)
+        wait_for_dom_settle(driver)
         return True
     except Exception:
         return False
@@ -219,22 +610,16 @@ def click_color_option(driver, color_name: str) -> bool:
 def click_size_option(driver, size: str) -> bool:
     """Click on a size option and wait for page to update."""
     try:
-        size_button = driver.find_element(By.XPATH, f"//ol[@class='qa--size-list' or @data-testid='size-list']//button[@data-size-value='{size}']")
-        driver.execute_script("arguments[0].scrollIntoView({block: 'center'});", size_button)
-        time.sleep(0.2)
+        wait_for_interactive(driver)
+        # One lookup covers both data-size-value buttons and plain radio buttons labelled with the size
+        size_button = _find_and_scroll(driver, _SIZE_BUTTON_TARGETS, size)
+        if size_button is None:
+            return False
+        
         size_button.click()
-        time.sleep(0.8)
+        clear_stock_cache(driver)
+        wait_for_dom_settle(driver)
         return True
-    except NoSuchElementException:
-        try:
-            size_button = driver.find_element(By.XPATH, f"//ol[@class='qa--size-list' or @data-testid='size-list']//button[role='radio' and text()='{size}']")
-            driver.execute_script("arguments[0].scrollIntoView({block: 'center'});", size_button)
-            time.sleep(0.2)
-            size_button.click()
-            time.sleep(0.8)
-            return True
-        except:
-            return False
     except Exception:
         return False
 
@@ -243,92 +628,357 @@ def check_stock_colors_only(driver, colors: List[str]) -> Dict[str, bool]:
     """Check stock status for products with colors only."""
     colors_stock = {}
     
-    # First pass: check all colors using class method
+    # Class checks are answered from one page snapshot, retaken only after a click,
+    # so only colors the class doesn't settle get clicked
     for color in colors:
         stock_status = check_color_stock_by_class(driver, color)
-        if stock_status is not None:
-            colors_stock[color] = stock_status
-    
-    # Second pass: click and check remaining colors
-    for color in colors:
-        if color not in colors_stock:
+        if stock_status is None:
             if click_color_option(driver, color):
-                time.sleep(0.8)
                 stock_status = check_button_for_stock(driver)
-                colors_stock[color] = stock_status if stock_status is not None else False
-            else:
-                colors_stock[color] = False
+        colors_stock[color] = stock_status if stock_status is not None else False
     
     return colors_stock
 
 
-def check_stock_with_sizes(driver, colors: List[str], sizes: List[str]) -> Dict[str, Dict[str, bool]]:
+# StockMatrix cell values
+_OUT_OF_STOCK, _IN_STOCK, _NOT_OFFERED = 0, 1, 2
+
+
+@dataclass
+class StockMatrix:
+    """
+    Color x size stock table stored as one flat row-major bytearray.
+    Each cell is _IN_STOCK, _OUT_OF_STOCK, or _NOT_OFFERED for sizes a color doesn't list.
+    Colors without a size list use a single 'ALL' column.
+    """
+    colors: List[str]
+    sizes: List[str]
+    cells: Optional[bytearray] = None
+    
+    def __post_init__(self):
+        if self.cells is None:
+            self.cells = bytearray([_NOT_OFFERED]) * (len(self.colors) * len(self.sizes))
+        self._color_index = {color: i for i, color in enumerate(self.colors)}
+        self._size_index = {size: j for j, size in enumerate(self.sizes)}
+    
+    def _cell(self, color: str, size: str) -> int:
+        return self._color_index[color] * len(self.sizes) + self._size_index[size]
+    
+    def add_size(self, size: str):
+        """Add a size column, e.g. one only some colors list."""
+        if size in self._size_index:
+            return
+        width = len(self.sizes)
+        self.sizes.append(size)
+        self._size_index[size] = width
+        # Re-layout rows with the extra column
+        cells = bytearray()
+        for i in range(len(self.colors)):
+            cells += self.cells[i * width:(i + 1) * width] + bytearray([_NOT_OFFERED])
+        self.cells = cells
+    
+    def set(self, color: str, size: str, in_stock: bool):
+        self.add_size(size)
+        self.cells[self._cell(color, size)] = _IN_STOCK if in_stock else _OUT_OF_STOCK
+    
+    def get(self, color: str, size: str) -> Optional[bool]:
+        """Stock for one cell, or None if the color doesn't offer that size."""
+        if color not in self._color_index or size not in self._size_index:
+            return None
+        value = self.cells[self._cell(color, size)]
+        return None if value == _NOT_OFFERED else value == _IN_STOCK
+    
+    def in_stock_count(self) -> int:
+        return self.cells.count(_IN_STOCK)
+    
+    def to_dict(self) -> Dict[str, Dict[str, bool]]:
+        """Nested {color: {size: in_stock}} form used by the scheduler and stored state."""
+        width = len(self.sizes)
+        result = {}
+        for i, color in enumerate(self.colors):
+            row = self.cells[i * width:(i + 1) * width]
+            offered = {size: row[j] == _IN_STOCK for j, size in enumerate(self.sizes) if row[j] != _NOT_OFFERED}
+            if offered:
+                result[color] = offered
+        return result
+
+
+def check_stock_with_sizes(driver, colors: List[str], sizes: List[str]) -> StockMatrix:
     """Check stock status for products with colors and sizes."""
-    color_size_stock = {}
+    matrix = StockMatrix(list(colors), list(sizes))
     
     for color in colors:
         if not click_color_option(driver, color):
             continue
         
-        time.sleep(0.8)
         current_sizes = get_all_sizes(driver)
         
         if not current_sizes:
             stock_status = check_button_for_stock(driver)
-            color_size_stock[color] = {'ALL': stock_status if stock_status is not None else False}
+            matrix.set(color, 'ALL', stock_status if stock_status is not None else False)
             continue
         
-        color_size_stock[color] = {}
+        # Read every size's class-based status at once; only unclear sizes need a click
+        statuses = check_sizes_stock_by_class(driver)
+        
         for size in current_sizes:
-            stock_status = check_size_stock_by_class(driver, size)
+            stock_status = statuses.get(size)
             if stock_status is None:
                 if click_size_option(driver, size):
-                    time.sleep(0.8)
                     stock_status = check_button_for_stock(driver)
-            color_size_stock[color][size] = stock_status if stock_status is not None else False
+            matrix.set(color, size, stock_status if stock_status is not None else False)
     
-    return color_size_stock
+    return matrix
 
 
-def check_stock_status(product_url: str, headless: bool = True) -> Tuple[Optional[Dict], Optional[bool], Optional[str]]:
+def _check_one(driver, product_url: str) -> Tuple[Optional[Dict], Optional[bool], Optional[str]]:
     """
-    Check stock status for a product.
-    Returns (stock_data, has_sizes, product_name) or (None, None, None) on error.
+    Check stock status for a product using an already running driver.
+    Returns (stock_data, has_sizes, product_name), or (None, None, None) if the page has no colors.
+    Raises on driver/page errors so callers can decide whether to restart the driver.
     """
-    driver = setup_driver(headless=headless)
-    if not driver:
+    # Reused drivers still show the previous product, whose widgets would satisfy the waits below
+    try:
+        previous_page = driver.find_element(By.TAG_NAME, "html")
+    except Exception:
+        previous_page = None
+    
+    driver.get(product_url)
+    clear_stock_cache(driver)
+    driver._page_interactive = False
+    if previous_page is not None:
+        WebDriverWait(driver, 15).until(EC.staleness_of(previous_page))
+    # Page loads don't block, so wait for what the scraper reads rather than for the whole document
+    WebDriverWait(driver, 15).until(EC.presence_of_element_located((By.CSS_SELECTOR, "fieldset.qa--colour-selector, h1")))
+    # The option lists may still be streaming in while the document is loading
+    wait_for_interactive(driver)
+    
+    # get_all_colors waits for the colour selector to render
+    colors = get_all_colors(driver)
+    if not colors:
         return None, None, None
     
+    # Try to get product name from page
     try:
-        driver.get(product_url)
-        WebDriverWait(driver, 10).until(EC.presence_of_element_located((By.TAG_NAME, "body")))
-        time.sleep(2)
-        
-        # Try to get product name from page
+        product_name = driver.find_element(By.TAG_NAME, "h1").text
+    except:
+        product_name = None
+    
+    sizes = get_all_sizes(driver)
+    has_sizes = len(sizes) > 0
+    
+    if has_sizes:
+        stock_data = check_stock_with_sizes(driver, colors, sizes).to_dict()
+    else:
+        stock_data = check_stock_colors_only(driver, colors)
+    
+    return stock_data, has_sizes, product_name
+
+
+_shared_driver = None
+_shared_driver_lock = threading.Lock()
+
+
+def get_shared_driver(headless: bool = True):
+    """Get the module-wide keep-alive driver, starting it on first use. Returns None if Chrome fails to start."""
+    global _shared_driver
+    with _shared_driver_lock:
+        if _shared_driver is None:
+            _shared_driver = setup_driver(headless=headless, attach_to=CHROME_DEBUGGER_ADDRESS)
+        return _shared_driver
+
+
+def release_shared_driver():
+    """Quit the shared driver, if one was started."""
+    global _shared_driver
+    with _shared_driver_lock:
+        driver, _shared_driver = _shared_driver, None
+    if driver is not None:
         try:
-            product_name = driver.find_element(By.TAG_NAME, "h1").text
+            driver.quit()
         except:
-            product_name = None
-        
-        colors = get_all_colors(driver)
-        if not colors:
+            pass
+
+
+atexit.register(release_shared_driver)
+
+
+def check_stock_status(product_url: str, headless: bool = True, driver=None) -> Tuple[Optional[Dict], Optional[bool], Optional[str]]:
+    """
+    Check stock status for a product.
+    Pass a driver (e.g. from get_shared_driver()) to reuse one browser across calls;
+    otherwise a driver is started for this call (attached to ARC_CHROME_DEBUGGER if set)
+    and quit afterwards.
+    Returns (stock_data, has_sizes, product_name) or (None, None, None) on error.
+    """
+    if HTTP_FIRST:
+        result = check_stock_status_http(product_url)
+        if result is not None:
+            return result
+    
+    own_driver = driver is None
+    if own_driver:
+        driver = setup_driver(headless=headless, attach_to=CHROME_DEBUGGER_ADDRESS)
+        if not driver:
             return None, None, None
-        
-        sizes = get_all_sizes(driver)
-        has_sizes = len(sizes) > 0
-        
-        if has_sizes:
-            stock_data = check_stock_with_sizes(driver, colors, sizes)
-        else:
-            stock_data = check_stock_colors_only(driver, colors)
-        
-        return stock_data, has_sizes, product_name
-        
+    else:
+        # Don't carry cookies over from the previous product
+        try:
+            driver.delete_all_cookies()
+        except Exception:
+            pass
+    
+    try:
+        return _check_one(driver, product_url)
     except Exception as e:
         print(f"Error checking stock: {e}", file=sys.stderr)
         return None, None, None
     finally:
+        if own_driver:
+            try:
+                driver.quit()
+            except:
+                pass
+
+
+class DriverPool:
+    """
+    Thread-safe pool of reusable Chrome drivers.
+    Drivers are started lazily, up to `size`, and handed back with put() after each page
+    so their startup cost is paid once per pool rather than once per URL.
+    With attach_to, the pool holds a single driver attached to that running Chrome.
+    """
+    
+    def __init__(self, size: int, headless: bool = True, attach_to: Optional[str] = None):
+        # Drivers attached to the same browser would steer the same tab, so only one is used
+        self.size = 1 if attach_to else max(1, size)
+        self.headless = headless
+        self.attach_to = attach_to
+        self._idle = queue.Queue()
+        self._created = 0
+        self._lock = threading.Lock()
+    
+    def get(self):
+        """Get an idle driver, starting a new one if the pool isn't full. Returns None if Chrome fails to start."""
+        while True:
+            try:
+                return self._idle.get_nowait()
+            except queue.Empty:
+                pass
+            
+            with self._lock:
+                can_create = self._created < self.size
+                if can_create:
+                    self._created += 1
+            if can_create:
+                driver = setup_driver(headless=self.headless, attach_to=self.attach_to)
+                if driver is None:
+                    with self._lock:
+                        self._created -= 1
+                return driver
+            
+            try:
+                return self._idle.get(timeout=1)
+            except queue.Empty:
+                # A driver may have been discarded meanwhile, so check again whether we can start one
+                continue
+    
+    def put(self, driver):
+        """Return a driver to the pool, clearing cookies so the next page starts clean."""
+        try:
+            driver.delete_all_cookies()
+        except Exception:
+            self.discard(driver)
+            return
+        self._idle.put(driver)
+    
+    def discard(self, driver):
+        """Quit a driver that is broken instead of returning it to the pool."""
         try:
             driver.quit()
         except:
-            pass
\ No newline at end of file
+            pass
+        with self._lock:
+            self._created -= 1
+    
+    def close(self):
+        """Quit every idle driver."""
+        while True:
+            try:
+                driver = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self.discard(driver)
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _check_with_pool(pool: DriverPool, product_url: str) -> Tuple[Tuple[Optional[Dict], Optional[bool], Optional[str]], bool]:
+    """
+    Check one product, trying the HTTP path first and borrowing a pooled driver otherwise.
+    Returns the result and whether it was read from the page HTML rather than a browser.
+    """
+    if HTTP_FIRST:
+        result = check_stock_status_http(product_url)
+        if result is not None:
+            return result, True
+    
+    driver = pool.get()
+    if not driver:
+        return (None, None, None), False
+    
+    try:
+        result = _check_one(driver, product_url)
+    except Exception as e:
+        print(f"Error checking stock for {product_url}: {e}", file=sys.stderr)
+        # Don't hand a possibly broken browser to the next URL
+        pool.discard(driver)
+        return (None, None, None), False
+    
+    pool.put(driver)
+    return result, False
+
+
+def check_stock_status_batch(product_urls: List[str], headless: bool = True, max_workers: int = 4,
+                             pool: Optional[DriverPool] = None,
+                             from_html: Optional[Set[str]] = None) -> Dict[str, Tuple[Optional[Dict], Optional[bool], Optional[str]]]:
+    """
+    Check stock status for several products in parallel, reusing pooled browsers.
+    Pages whose embedded JSON can be read directly never start a browser.
+    Pass a pool to keep its browsers alive across batches; otherwise one is created
+    for this call (attached to ARC_CHROME_DEBUGGER if set) and closed when it finishes.
+    Returns a dict mapping each URL to (stock_data, has_sizes, product_name),
+    with (None, None, None) for URLs that could not be checked.
+    Pass a set as from_html to collect the URLs whose result came from the page HTML.
+    """
+    if not product_urls:
+        return {}
+    
+    workers = max(1, min(max_workers, len(product_urls)))
+    own_pool = pool is None
+    if own_pool:
+        pool = DriverPool(workers, headless=headless, attach_to=CHROME_DEBUGGER_ADDRESS)
+    
+    results = {}
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(_check_with_pool, pool, url): url for url in product_urls}
+            for future in as_completed(futures):
+                url = futures[future]
+                try:
+                    results[url], html_result = future.result()
+                    if html_result and from_html is not None:
+                        from_html.add(url)
+                except Exception as e:
+                    # One bad product must not cost the rest of the batch their results
+                    print(f"Error checking stock for {url}: {e}", file=sys.stderr)
+                    results[url] = (None, None, None)
+    finally:
+        if own_pool:
+            pool.close()
+    
+    return results
@@ -63,6 +63,7 @@ def main():
     # --- All previous UI code is commented out below ---
 
     # import json
+    # import pandas as pd
     # import os
     # import sys
     # import hashlib
@@ -78,25 +79,19 @@ def main():
     # sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
     # load_dotenv()
     #
-    # def get_env_var(key, default=None):
-    #     try:
-    #         if hasattr(st, 'secrets') and key in st.secrets:
-    #             return st.secrets[key]
-    #     except Exception:
-    #         pass
-    #     return os.getenv(key, default)
+    # # Cached in mailer, which Streamlit imports once, so the cache survives reruns of this script
+    # from mailer import get_env_var
     #
-    # from db import load_subscriptions, save_subscriptions, delete_subscription, get_popular_items, get_last_in_stock_times
+    # from db import load_subscriptions, save_subscriptions, delete_subscription, get_popular_items_with_history, get_subscription_by_token, get_subscriptions_by_email, save_subscription, set_verified
     # from rate_limiter import check_rate_limit, record_rate_limit_attempt, get_session_id, cleanup_old_attempts
     #
+    # # Existing rows (and the new site) use this id, so it stays md5 for compatibility;
+    # # uniqueness of (email, product_url) is enforced by subscriptions_email_product_url_key
     # def get_subscription_key(email, product_url):
     #     return hashlib.md5(f"{email}:{product_url}".encode()).hexdigest()
     #
-    # def send_verification_email(email, token, product_url):
-    #     ...
-    #
-    # def send_stock_notification(email, product_name, product_url, back_in_stock, out_of_stock):
-    #     ...
+    # # Email bodies are rendered from app/templates and sent over the pooled SMTP connection
+    # from mailer import send_verification_email_async
     #
     # # Verification handling
     # try:
@@ -112,21 +107,14 @@ def main():
     #
     #     if token:
     #         token = unquote(str(token))
-    #         subscriptions = load_subscriptions()
-    #         verified = False
-    #         for sub_key, sub in subscriptions.items():
-    #             sub_token = sub.get('token', '')
-    #             if sub_token and sub_token == token:
-    #                 sub['verified'] = True
-    #                 save_subscriptions(subscriptions)
-    #                 st.success("Email verified! You will now receive stock alerts.")
-    #                 st.balloons()
-    #                 verified = True
-    #                 break
-    #         if not verified:
-    #             st.error("Invalid verification token.")
-    #         else:
+    #         hit = get_subscription_by_token(token)
+    #         if hit:
+    #             sub_key, sub = hit
+    #             set_verified(sub_key)
+    #             st.success("Email verified! You will now receive stock alerts.")
+    #             st.balloons()
     #             return
+    #         st.error("Invalid verification token.")
     # except Exception as e:
     #     st.error(f"Error processing verification: {str(e)}")
     #
@@ -138,18 +126,42 @@ def main():
     #
     # if page == "Subscribe":
     #     st.header("Subscribe for Stock Alerts")
-    #     email = st.text_input("Your Email", placeholder="your.email@example.com")
-    #     product_url = st.text_input("Product URL", placeholder="https://arcteryx.com/ca/en/shop/...")
-    #     if st.button("Subscribe", type="primary"):
+    #     # A form reruns the script once on submit instead of on every keystroke
+    #     with st.form("subscribe_form", clear_on_submit=False):
+    #         email = st.text_input("Your Email", placeholder="your.email@example.com")
+    #         product_url = st.text_input("Product URL", placeholder="https://arcteryx.com/ca/en/shop/...")
+    #         submitted = st.form_submit_button("Subscribe", type="primary")
+    #     if submitted:
     #         ...
+    #         # Don't block the rerun on SMTP; the email is sent in the background
+    #         st.session_state.setdefault('pending_emails', {})[email] = send_verification_email_async(email, token, product_url)
+    #         st.success("Subscription created — verification email is on its way.")
     #
     # elif page == "My Subscriptions":
     #     st.header("My Subscriptions")
-    #     ...
+    #     with st.form("my_subscriptions_form"):
+    #         email_input = st.text_input("Your Email", placeholder="your.email@example.com")
+    #         if st.form_submit_button("Load subscriptions"):
+    #             st.session_state['my_subscriptions_email'] = email_input.strip()
+    #     # Kept in session state so the list survives reruns from the unsubscribe buttons
+    #     email = st.session_state.get('my_subscriptions_email')
+    #     if email:
+    #         user_subs = list(get_subscriptions_by_email(email).items())
+    #         ...
     #
     # elif page == "Popular Items":
     #     st.header("Popular Items")
-    #     ...
+    #     for item, last_in_stock in get_popular_items_with_history(limit=50):
+    #         ...
+    #         for color, size_times in last_in_stock.items():
+    #             # Parse and format every timestamp of a color at once instead of one fromisoformat per cell
+    #             times = pd.Series(size_times, dtype=object)
+    #             parsed = pd.to_datetime(times, utc=True, errors='coerce')
+    #             table_data = pd.DataFrame({
+    #                 'Size': [size or 'All' for size in times.index],
+    #                 'Last In Stock': parsed.dt.strftime('%Y-%m-%d %H:%M:%S').fillna(times.astype(str)).values,
+    #             }).sort_values('Last In Stock', ascending=False)
+    #             st.dataframe(table_data, hide_index=True)
     #
     # elif page == "Tutorial":
     #     st.header("How to Subscribe - Step by Step Tutorial")
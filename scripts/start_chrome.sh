@@ -0,0 +1,39 @@
+#!/usr/bin/env bash
+# Start a long-running headless Chrome the scraper can attach to, so each run
+# skips the browser cold start:
+#
+#   scripts/start_chrome.sh
+#   export ARC_CHROME_DEBUGGER=127.0.0.1:9222   # or set it in .env
+#   cd app && python scheduler.py --once
+#
+# While attached, browser checks run one at a time in that Chrome; pages
+# read over plain HTTP are still checked in parallel.
+set -euo pipefail
+
+PORT="${CHROME_DEBUG_PORT:-9222}"
+PROFILE_DIR="${CHROME_PROFILE_DIR:-/tmp/arc-scraper-chrome}"
+
+if [ -n "${CHROME_BIN:-}" ]; then
+  CHROME="$CHROME_BIN"
+elif [ -x "/Applications/Google Chrome.app/Contents/MacOS/Google Chrome" ]; then
+  CHROME="/Applications/Google Chrome.app/Contents/MacOS/Google Chrome"
+else
+  CHROME="$(command -v google-chrome || command -v google-chrome-stable || command -v chromium)"
+fi
+
+"$CHROME" \
+  --headless=new \
+  --remote-debugging-address=127.0.0.1 \
+  --remote-debugging-port="$PORT" \
+  --user-data-dir="$PROFILE_DIR" \
+  --no-sandbox \
+  --disable-dev-shm-usage \
+  --disable-gpu \
+  --disable-blink-features=AutomationControlled \
+  --window-size=1920,1080 \
+  --user-agent='Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36' \
+  --blink-settings=imagesEnabled=false \
+  about:blank >/dev/null 2>&1 &
+
+echo "Chrome listening on 127.0.0.1:$PORT (pid $!)"
+echo "export ARC_CHROME_DEBUGGER=127.0.0.1:$PORT"
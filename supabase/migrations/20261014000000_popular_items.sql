@@ -0,0 +1,16 @@
+-- Popular items aggregated server-side, used by db.get_popular_items
+create or replace view popular_items as
+select
+    ss.product_url,
+    count(*)::int as subscription_count,
+    ss.product_name,
+    ss.has_sizes,
+    ss.last_checked
+from subscriptions s
+join stock_state ss on ss.product_url = s.product_url
+where s.verified
+group by ss.product_url, ss.product_name, ss.has_sizes, ss.last_checked;
+
+create index if not exists subscriptions_verified_product_url_idx
+    on subscriptions (product_url)
+    where verified;
@@ -0,0 +1,18 @@
+-- Latest back-in-stock time per product/color/size, used by db.get_last_in_stock_times.
+-- stock_history stays as the append-only event log.
+create table if not exists stock_last_in_stock (
+    product_url text not null,
+    color text not null,
+    size text,
+    came_back_in_stock_at timestamptz not null,
+    constraint stock_last_in_stock_ucs unique nulls not distinct (product_url, color, size)
+);
+
+-- Backfill from the existing history
+insert into stock_last_in_stock (product_url, color, size, came_back_in_stock_at)
+select distinct on (product_url, color, size)
+    product_url, color, size, came_back_in_stock_at::timestamptz
+from stock_history
+order by product_url, color, size, came_back_in_stock_at desc
+on conflict (product_url, color, size)
+    do update set came_back_in_stock_at = excluded.came_back_in_stock_at;
@@ -0,0 +1,3 @@
+-- HTTP validators from the last scrape, used to skip unchanged product pages
+alter table stock_state add column if not exists etag text;
+alter table stock_state add column if not exists last_modified text;
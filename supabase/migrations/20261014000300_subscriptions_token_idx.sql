@@ -0,0 +1,3 @@
+-- Verification links look subscriptions up by token, used by db.get_subscription_by_token
+create index if not exists subscriptions_token_idx
+    on subscriptions (token);
@@ -0,0 +1,3 @@
+-- My Subscriptions looks subscriptions up by email, used by db.get_subscriptions_by_email
+create index if not exists subscriptions_email_idx
+    on subscriptions (email);
@@ -0,0 +1,4 @@
+-- One subscription per email and product, enforced by the database rather than by the
+-- md5(email:product_url) id alone, so ids no longer have to be derived from those columns
+create unique index if not exists subscriptions_email_product_url_key
+    on subscriptions (email, product_url);
@@ -0,0 +1,63 @@
+"""
+Tests for reading stock from a product page's embedded page data
+Run from the repo root: python -m unittest discover tests
+"""
+import os
+import re
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+from scraper import parse_product_json
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+PRODUCT_URL = 'https://arcteryx.com/ca/en/shop/mens/beta-jacket'
+
+
+def load_fixture(name: str) -> str:
+    with open(os.path.join(FIXTURES, name), encoding='utf-8') as f:
+        return f.read()
+
+
+def with_page_data(html: str, page_data: str) -> str:
+    """Swap the fixture's __NEXT_DATA__ payload for another one."""
+    return re.sub(r'(<script id="__NEXT_DATA__"[^>]*>).*?(</script>)',
+                  lambda m: m.group(1) + page_data + m.group(2), html, flags=re.DOTALL)
+
+
+class ParseProductJsonTests(unittest.TestCase):
+    
+    def setUp(self):
+        self.html = load_fixture('product_page.html')
+    
+    def test_reads_the_page_product_not_a_related_one(self):
+        stock_data, has_sizes, product_name = parse_product_json(self.html, PRODUCT_URL)
+        self.assertTrue(has_sizes)
+        self.assertEqual(product_name, 'Beta Jacket')
+        self.assertEqual(stock_data, {
+            'Black': {'S': True, 'M': False, 'L': True},
+            'Stone Wash': {'S': False, 'M': True, 'L': False},
+        })
+    
+    def test_url_of_another_product_falls_back_to_browser(self):
+        self.assertIsNone(parse_product_json(self.html, 'https://arcteryx.com/ca/en/shop/mens/alpha-sv-jacket'))
+    
+    def test_product_without_slug_falls_back_to_browser(self):
+        page_data = '{"props": {"pageProps": {"product": {"name": "X", "colourOptions": [{"value": "c1", "label": "Black"}], "variants": [{"colourId": "c1", "inStock": true}]}}}}'
+        self.assertIsNone(parse_product_json(with_page_data(self.html, page_data), PRODUCT_URL))
+    
+    def test_options_and_variants_without_ids_fall_back_to_browser(self):
+        page_data = '{"product": {"slug": "beta-jacket", "name": "X", "colourOptions": [{"label": "Black"}], "variants": [{"inStock": true}]}}'
+        self.assertIsNone(parse_product_json(with_page_data(self.html, page_data), PRODUCT_URL))
+    
+    def test_non_letter_sizes_are_color_only(self):
+        page_data = '{"product": {"slug": "beta-jacket", "name": "X", "colourOptions": [{"value": "c1", "label": "Black"}], "sizeOptions": [{"value": "s1", "label": "32"}], "variants": [{"colourId": "c1", "sizeId": "s1", "inStock": true}]}}'
+        self.assertEqual(parse_product_json(with_page_data(self.html, page_data), PRODUCT_URL), ({'Black': True}, False, 'X'))
+    
+    def test_malformed_variant_falls_back_to_browser(self):
+        page_data = '{"product": {"slug": "beta-jacket", "name": "X", "colourOptions": [{"value": "c1", "label": "Black"}], "variants": [{"colourId": "c1", "inStock": true}, null]}}'
+        self.assertIsNone(parse_product_json(with_page_data(self.html, page_data), PRODUCT_URL))
+
+
+if __name__ == '__main__':
+    unittest.main()